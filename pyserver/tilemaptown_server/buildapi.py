@@ -18,6 +18,7 @@ from aiohttp import web, ClientSession
 from string import Template
 from .buildglobal import *
 from .buildentity import Entity
+from .buildmap import load_map_data_from_db, map_data_section_from_db
 
 start_time = int(time.time())
 
@@ -126,28 +127,34 @@ async def map_info(request):
 		return map
 
 	data = {}
-	if int(request.query.get('info', 1)):
+	want_info = int(request.query.get('info', 1))
+	if want_info:
 		data["info"] = map.map_info()
+	headers = dict(MAIN_API_CORS_HEADERS, Vary='Accept-Encoding') # Whether the response is gzipped depends on Accept-Encoding
 	try:
 		if int(request.query.get('data', 0)):
 			if map.map_data_loaded:
-				data["data"] = map.map_section(0, 0, map.width-1, map.height-1)
+				# Use the map's cached JSON instead of encoding the whole map again
+				if not want_info and 'gzip' in request.headers.get('Accept-Encoding', ''):
+					return web.Response(body=map.map_data_gzip(), content_type='application/json', headers=dict(headers, **{'Content-Encoding': 'gzip'}))
+				before_data = json.dumps(data)[:-1] + ',' if data else '{'
+				return web.Response(text=before_data + '"data":' + map.map_data_json() + '}', content_type='application/json', headers=headers)
 			else:
-				from_db = map.load_data_as_text()
+				from_db = load_map_data_from_db(map.db_id)
 				if from_db != None:
-					from_db = json.loads(from_db)
+					extra, map_data = map_data_section_from_db(from_db, map.default_turf)
 
 					# Patch in the edge ID links and wallpaper so map.map_info() can include them
-					if "edge_links" in from_db:
-						map.edge_id_links = from_db["edge_links"]
-					if "wallpaper" in from_db:
-						map.map_wallpaper = from_db["wallpaper"]
+					if "edge_links" in extra:
+						map.edge_id_links = extra["edge_links"]
+					if "wallpaper" in extra:
+						map.map_wallpaper = extra["wallpaper"]
 
 					data["info"] = map.map_info()
-					data["data"] = {'pos': from_db['pos'], 'default': from_db['default'], 'turf': from_db['turf'], 'obj': from_db['obj']}
+					data["data"] = map_data
 	except:
 		pass
-	return web.json_response(data, headers=MAIN_API_CORS_HEADERS)
+	return web.json_response(data, headers=headers)
 
 @routes.get('/v1/tsd/{id}')
 async def get_tsd(request):
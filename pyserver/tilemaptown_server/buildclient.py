@@ -86,19 +86,19 @@ class BuildSession(object):
 				_, x, y, new, old = a
 				x = int(x)
 				y = int(y)
-				if map.turfs[x][y] != json.loads(new):
+				if map.get_turf(x, y) != json.loads(new):
 					different.append((x,y))
 				else:
-					map.turfs[x][y] = json.loads(old)
+					map.put_turf(x, y, json.loads(old))
 					map.broadcast("MAP", map.map_section(x, y, x, y), send_to_links=True)
 			elif a[0] == 'o':
 				_, x, y, new, old = a
 				x = int(x)
 				y = int(y)
-				if map.objs[x][y] != json.loads(new):
+				if map.get_objs(x, y) != json.loads(new):
 					different.append((x,y))
 				else:
-					map.objs[x][y] = json.loads(old)
+					map.put_objs(x, y, json.loads(old))
 					map.broadcast("MAP", map.map_section(x, y, x, y), send_to_links=True)
 			elif a[0] == 'd':
 				_, x1, y1, x2, y2, old, turf, objs = a
@@ -298,8 +298,10 @@ class Connection(object):
 		self.oper_override = False
 		self.client_name = None
 
-		self.ping_timer = 180
-		self.idle_timer = 0
+		self.ping_deadline = None
+		self.ping_timer_handle = None
+		self.reset_ping_timer(180)
+		self.last_message_at = time.monotonic()
 		self.connected_time = int(time.time())
 		self.sent_resources_yet = False
 		self.images_and_tilesets_received_so_far = set()
@@ -352,6 +354,8 @@ class Connection(object):
 		self.can_forward_messages_to = False
 		self.user_watch_with_who = False
 		self.can_acknowledge = False
+		self.caches_maps = False
+		self.cached_map_versions = {} # "map_cache" extension; str(map protocol ID) -> content version the client has
 		self.features = set() # list of feature names
 
 	def load_settings(self, username):
@@ -399,6 +403,7 @@ class Connection(object):
 		# Update the user
 		values = (self.username, dumps_if_not_empty(list(self.watch_list)), dumps_if_not_empty(list(self.ignore_list)), self.client_settings, datetime.datetime.now(), self.user_flags, db_id)
 		c.execute("UPDATE User SET username=?, watch=?, ignore=?, client_settings=?, last_seen_at=?, flags=? WHERE entity_id=?", values)
+		remember_username(db_id, self.username)
 
 	def changepass(self, password):
 		# Generate a random salt and append it to the password
@@ -408,7 +413,7 @@ class Connection(object):
 
 		c = Database.cursor()
 		c.execute("UPDATE User SET passhash=?, passalgo=? WHERE entity_id=?", (passhash, "sha512", self.db_id))
-		Database.commit()
+		commit_database_soon()
 
 	def register(self, username, password):
 		username = str(filter_username(username))
@@ -435,7 +440,41 @@ class Connection(object):
 		if self.make_batch and self.can_batch_messages:
 			self.messages_in_batch.append(raw)
 		else:
-			asyncio.ensure_future(self.ws.send(raw))
+			self.write_string(raw)
+
+	def write_string(self, raw):
+		""" Write a string to the websocket immediately, without making a task for it """
+		if self.ws == None:
+			return
+		websockets.broadcast((self.ws,), raw)
+
+	def websocket_for_broadcast(self):
+		""" Get the websocket that a broadcast can write to directly, or None if the message has to go through send_string() """
+		if self.make_batch and self.can_batch_messages:
+			return None
+		return self.ws
+
+	def reset_ping_timer(self, seconds):
+		""" Disconnect the client if it doesn't send a ping within this many seconds, and ping them when the time is almost up """
+		if self.ping_timer_handle != None:
+			self.ping_timer_handle.cancel()
+		self.ping_deadline = time.monotonic() + seconds
+		self.ping_timer_handle = call_later_weakly(max(0, seconds - 60), Connection.ping_timer_expired, self)
+
+	def ping_timer_expired(self):
+		if self.ws == None:
+			return
+		time_left = self.ping_deadline - time.monotonic()
+		if time_left > 45:
+			self.send("PIN", None)
+			self.ping_timer_handle = call_later_weakly(time_left - 30, Connection.ping_timer_expired, self)
+		elif time_left > 15:
+			self.send("PIN", None)
+			self.ping_timer_handle = call_later_weakly(time_left, Connection.ping_timer_expired, self)
+		elif time_left > 0:
+			self.ping_timer_handle = call_later_weakly(time_left, Connection.ping_timer_expired, self)
+		else:
+			self.disconnect(reason="PingTimeout")
 
 	def start_batch(self):
 		""" Start batching messages """
@@ -454,9 +493,9 @@ class Connection(object):
 		if n == 0:
 			return
 		elif n == 1: # If there's one message, format it normally
-			asyncio.ensure_future(self.ws.send(self.messages_in_batch[0]))
+			self.write_string(self.messages_in_batch[0])
 		else:
-			asyncio.ensure_future(self.ws.send("BAT "+"\n".join(self.messages_in_batch)))
+			self.write_string("BAT "+"\n".join(self.messages_in_batch))
 		# Clear out the batch
 		self.messages_in_batch = []
 
@@ -732,12 +771,11 @@ class Connection(object):
 				data['remote_map'] = map_id
 				self.send("MAI", data)
 
-				data = map.map_section(0, 0, map.width-1, map.height-1)
-				data['remote_map'] = map_id
-				self.send("MAP", data)
+				self.send_string(map.map_data_message(remote_map=map_id))
 				self.finish_batch()
 		elif category_id == maplisten_type['entry']:
 			if map_id in AllEntitiesByDB: # Entity currently loaded
+				# Full list even on nearby-only maps; remote listeners have no position to be near, and get every entity's updates
 				self.send("WHO", {'list': AllEntitiesByDB[map_id].who_contents(), 'remote_map': map_id})
 			else:                         # Entity is not loaded
 				self.send("WHO", {'list': [], 'remote_map': map_id})
@@ -255,6 +255,7 @@ def fn_nick(map, client, context, arg):
 		client.name = arg
 		c = Database.cursor()
 		c.execute("UPDATE Entity SET name=? WHERE id=?", (arg, client.db_id))
+		EntityNameAndType.discard(client.db_id)
 
 @cmd_command(category="Settings", syntax="description")
 def fn_userdesc(map, client, context, arg):
@@ -276,33 +277,70 @@ def fn_me(map, client, context, arg):
 		return
 	send_message_to_map(map, client, "/me "+arg, context)
 
+class RateLimiter(object):
+	""" Token buckets for one kind of rate limiting on one entity; one bucket per (minutes, max count) limit """
+	__slots__ = ('updated_at', 'tokens', 'capacity', 'refill')
+
+	def __init__(self, count_limits):
+		self.updated_at = time.monotonic()
+		self.capacity = [max_count_allowed for amount_of_minutes, max_count_allowed in count_limits]
+		self.refill = [max_count_allowed / (amount_of_minutes * 60) for amount_of_minutes, max_count_allowed in count_limits] # Tokens per second
+		self.tokens = list(self.capacity)
+
+	def hit(self, count_limits):
+		""" Count one use, and return True if it went over any of the limits """
+		now = time.monotonic()
+		elapsed = now - self.updated_at
+		self.updated_at = now
+		if len(self.tokens) != len(count_limits):
+			self.capacity = [max_count_allowed for amount_of_minutes, max_count_allowed in count_limits]
+			self.refill = [max_count_allowed / (amount_of_minutes * 60) for amount_of_minutes, max_count_allowed in count_limits]
+			self.tokens = list(self.capacity)
+		over_limit = False
+		for i, limit in enumerate(count_limits):
+			amount_of_minutes, max_count_allowed = limit
+			# Refill at the rate that would use up the whole limit over its window, then take out this use.
+			# Uses that go over the limit still count, down to one extra window's worth.
+			tokens = min(max_count_allowed, self.tokens[i] + elapsed * max_count_allowed / (amount_of_minutes * 60)) - 1
+			self.tokens[i] = max(tokens, -max_count_allowed)
+			self.capacity[i] = max_count_allowed
+			self.refill[i] = max_count_allowed / (amount_of_minutes * 60)
+			if tokens < 0:
+				over_limit = True
+		return over_limit
+
+	def utilization(self):
+		""" How close this is to the limit right now, as a fraction of the most used up bucket """
+		if not self.capacity:
+			return 0
+		# Count what would have refilled since the last use, without changing anything
+		elapsed = time.monotonic() - self.updated_at
+		return max(1 - (min(capacity, tokens + elapsed * refill) / capacity) for tokens, capacity, refill in zip(self.tokens, self.capacity, self.refill))
+
+rate_limiting_memory = 10 # Minutes since the last use before an entity's rate limiting information can be forgotten
+
+def expire_rate_limiting(client):
+	""" Remove rate limiters that haven't been used recently, and check again later if there's any left """
+	if not client.rate_limiting:
+		return
+	forget_before = time.monotonic() - rate_limiting_memory * 60
+	for type_name, limiter in list(client.rate_limiting.items()):
+		if limiter.updated_at <= forget_before:
+			del client.rate_limiting[type_name]
+	if client.rate_limiting:
+		oldest_update = min(limiter.updated_at for limiter in client.rate_limiting.values())
+		call_later_weakly(oldest_update - forget_before, expire_rate_limiting, client)
+
 def apply_rate_limiting(client, limit_type, count_limits):
 	if client.rate_limiting == None:
 		client.rate_limiting = {}
-	current_minute = int(time.monotonic() // 60)
-
-	# Increase the counter for the current minute
-	if limit_type not in client.rate_limiting:
-		client.rate_limiting[limit_type] = deque()
-		AllEntitiesWithRateLimiting.add(client)
-	for minutes in client.rate_limiting[limit_type]:
-		if minutes[0] == current_minute:
-			minutes[1] += 1
-			break
-	else:
-		client.rate_limiting[limit_type].append([current_minute, 1])	
-
-	# Check against every limit supplied here
-	for limit in count_limits:
-		amount_of_minutes, max_count_allowed = limit
-
-		total = 0
-		for counts in client.rate_limiting[limit_type]:
-			if counts[0] > (current_minute - amount_of_minutes):
-				total += counts[1]
-		if total > max_count_allowed:
-			return True
-	return False
+	limiter = client.rate_limiting.get(limit_type)
+	if limiter == None:
+		limiter = RateLimiter(count_limits)
+		client.rate_limiting[limit_type] = limiter
+		if len(client.rate_limiting) == 1:
+			call_later_weakly(rate_limiting_memory * 60, expire_rate_limiting, client)
+	return limiter.hit(count_limits)
 
 def send_message_to_map(map, actor, text, context, acknowledge_only=False, ignore_action="chat"):
 	if text == '':
@@ -485,15 +523,16 @@ def send_request_to_user(client, context, arg, request_type, request_data, accep
 		if u.requests[request_key][2] == request_data:
 			# Renew it
 			respond(context, 'You\'ve already sent them a request', error=True)
-			u.requests[request_key][0] = Config["Server"]["RequestExpirationTime"]
+			u.requests[request_key][0] = time.monotonic() + Config["Server"]["RequestExpirationTime"]
 			return
 	if not is_client_and_entity(u) or not in_blocked_username_list(client, u.connection_attr('ignore_list'), display_action='send requests to %s' % u.name, check_action="request", friends_list=u.connection_attr('watch_list'), recipient=u):
 		respond(context, you_message % arg)
 
 		if u.requests == None:
 			u.requests = {}
-		u.requests[request_key] = [Config["Server"]["RequestExpirationTime"] if u.is_client() else 60, next_request_id, request_data]
-		AllEntitiesWithRequests.add(u)
+		expire_in = Config["Server"]["RequestExpirationTime"] if u.is_client() else 60
+		u.requests[request_key] = [time.monotonic() + expire_in, next_request_id, request_data]
+		call_later_weakly(expire_in, expire_request, u, request_key, next_request_id)
 
 		if u.entity_type == entity_type['gadget']:
 			u.receive_request(client, request_type, request_data, accept_command, decline_command)
@@ -612,6 +651,17 @@ def fn_giveitem(map, client, context, arg):
 
 	send_request_to_user(client, context, arg_name, "giveitem", (weakref.ref(e), arg_givetype), "tpaccept", "tpdeny", text_for_you, text_for_them)
 
+def expire_request(entity, request_key, request_id):
+	""" Remove a request once it's too old, unless it was renewed in the meantime """
+	request = entity.requests.get(request_key) if entity.requests else None
+	if request == None or request[1] != request_id:
+		return
+	time_left = request[0] - time.monotonic()
+	if time_left > 0:
+		call_later_weakly(time_left, expire_request, entity, request_key, request_id)
+	else:
+		del entity.requests[request_key]
+
 def find_request_from_arg(client, context, arg):
 	args = arg.split(' ')
 	if len(args) == 0:
@@ -1008,8 +1058,8 @@ def fn_tempmapcopy(map, client, context, arg):
 
 	# Copy map data
 	e.blank_map(e.width, e.height)
-	e.turfs = copy.deepcopy(map.turfs)
-	e.objs = copy.deepcopy(map.objs)
+	e.turfs = map.turfs.copy()
+	e.objs = map.objs.copy()
 	e.map_wallpaper = copy.deepcopy(map.map_wallpaper)
 	e.map_music = copy.deepcopy(map.map_music)
 	e.name = e.name + " (temp copy)"
@@ -1596,6 +1646,21 @@ def fn_mapbuild(map, client, context, arg):
 		return
 	map.resend_map_info_to_users(mai_only=True)
 
+@cmd_command(category="Map", privilege_level="map_admin", map_only=True, syntax="on/off")
+def fn_mapnearbyonly(map, client, context, arg):
+	if arg == "on":
+		map.map_flags |= mapflag['nearby_only']
+		if map.aoi_grid == None:
+			map.start_area_of_interest()
+	elif arg == "off":
+		map.map_flags &= ~mapflag['nearby_only']
+		if map.aoi_grid != None:
+			map.stop_area_of_interest(resend_who=True)
+	else:
+		respond(context, 'Nearby-only mode must be on or off', error=True)
+		return
+	map.save_on_clean_up = True
+
 @cmd_command(category="Map", privilege_level="map_admin", map_only=True, syntax="on/off")
 def fn_mapdisablesave(map, client, context, arg):
 	if hasattr(map, "map_is_temp_copy") and map.map_is_temp_copy:
@@ -1612,13 +1677,13 @@ def fn_mapdefaultfloor(map, client, context, arg):
 	as_json = load_json_if_valid(arg)
 	if as_json != None:
 		if tile_is_okay(as_json):
-			map.default_turf = as_json
+			map.set_default_turf(as_json)
 			map.save_on_clean_up = True
 			respond(context, 'Map floor changed to custom tile %s' % arg)
 		else:
 			respond(context, 'Map floor not changed, custom tile not ok: %s' % arg)
 	else:
-		map.default_turf = arg
+		map.set_default_turf(arg)
 		map.save_on_clean_up = True
 		respond(context, 'Map floor changed to %s' % arg)
 	map.resend_map_info_to_users(mai_only=False)
@@ -1726,36 +1791,18 @@ def fn_mapsize(map, client, context, arg):
 		# Check if it would delete anything
 		for y in range(map.height):
 			for x in range(map.width - width):
-				if map.turfs[x + width][y] or map.objs[x + width][y]:
+				if map.get_turf(x + width, y) or map.get_objs(x + width, y):
 					respond(context, 'Can\'t shrink map horizontally, there\'s something at %d,%d' % (x + width, y))
 					return
 	if height < map.height:
 		# Check if it would delete anything
 		for y in range(map.height - height):
 			for x in range(map.width):
-				if map.turfs[x][y + height] or map.objs[x][y + height]:
+				if map.get_turf(x, y + height) or map.get_objs(x, y + height):
 					respond(context, 'Can\'t shrink map vertically, there\'s something at %d,%d' % (x, y + height))
 					return
 
-	# Array is [x][y]
-	if width > map.width:
-		for i in range(width - map.width):
-			map.turfs.append([None] * map.height)
-			map.objs.append([None] * map.height)
-	elif width < map.width:
-		del map.turfs[width:]
-		del map.objs[width:]
-	map.width = width
-		
-	if height > map.height:
-		for i in range(map.width):
-			map.turfs[i].extend([None] * (height-map.height))
-			map.objs[i].extend([None] * (height-map.height))
-	elif height < map.height:
-		for i in range(map.width):
-			del map.turfs[i][height:]
-			del map.objs[i][height:]
-	map.height = height
+	map.resize_map(width, height)
 
 	respond(context, 'This map\'s size is now %d,%d' % (map.width, map.height))
 	map.resend_map_info_to_users()
@@ -1787,20 +1834,20 @@ def clone_tile_into_inventory(client, tile):
 
 @cmd_command(category="Map", map_only=True)
 def fn_getturf(map, client, context, arg):
-	turf = map.turfs[client.x][client.y]
+	turf = map.get_turf(client.x, client.y)
 	if turf == None:
 		respond(context, 'You\'re not standing on a non-default turf', error=True)
 		return
-	clone_tile_into_inventory(client, turf)
+	clone_tile_into_inventory(client, copy.deepcopy(turf))
 
 @cmd_command(category="Map", map_only=True)
 def fn_getobj(map, client, context, arg):
-	objs = map.objs[client.x][client.y]
+	objs = map.get_objs(client.x, client.y)
 	if objs == None:
 		respond(context, 'You\'re not standing on any objs', error=True)
 		return
 	for obj in objs:
-		clone_tile_into_inventory(client, obj)
+		clone_tile_into_inventory(client, copy.deepcopy(obj))
 
 @cmd_command()
 def fn_listeners(map, client, context, arg):
@@ -2003,6 +2050,18 @@ def fn_ipwho(map, client, context, arg):
 		names += "%s [%s]" % (u.name_and_username(), ipaddress.ip_address(connection.ip).exploded or "?")
 	respond(context, 'List of users connected: '+names)
 
+@cmd_command(category="Server Admin", privilege_level="server_admin", syntax="username/id", no_entity_needed=True)
+def fn_ratelimits(map, client, context, arg):
+	e = find_client_by_username(arg)
+	if e == None:
+		failed_to_find(context, arg)
+		return
+	if not e.rate_limiting:
+		respond(context, '%s has no rate limiting information' % e.name_and_username())
+		return
+	limits = "".join("[li][b]%s[/b]: %d%%[/li]" % (limit_type, round(limiter.utilization() * 100)) for limit_type, limiter in sorted(e.rate_limiting.items()))
+	respond(context, 'Rate limiting for %s: [ul]%s[/ul]' % (e.name_and_username(), limits))
+
 @cmd_command(category="Server Admin", privilege_level="server_admin", no_entity_needed=True)
 def fn_ipwho2(map, client, context, arg):
 	names = ''
@@ -2068,7 +2127,7 @@ def fn_ipban(map, client, context, arg):
 		respond(context, 'Invalid IP format "%s"' % ip, error=True)
 		return
 
-	Database.commit()
+	commit_database_soon()
 	respond(context, 'Banned %s for "%s"; unban at %s' % (ip, reason, expiry or "never"))
 
 @cmd_command(category="Server Admin", privilege_level="server_admin", syntax="ip", no_entity_needed=True)
@@ -2077,7 +2136,7 @@ def fn_ipunban(map, client, context, arg):
 	c.execute('DELETE FROM Server_Ban WHERE ip=?', (arg,))
 	c.execute('SELECT changes()')
 	respond(context, 'Bans removed: %d' % c.fetchone()[0])
-	Database.commit()
+	commit_database_soon()
 
 @cmd_command(category="Server Admin", privilege_level="server_admin", no_entity_needed=True)
 def fn_ipbanlist(map, client, context, arg):
@@ -2730,6 +2789,7 @@ def fn_namegroup(map, client, context, arg):
 		return
 	c = Database.cursor()
 	c.execute('UPDATE Entity SET name=? WHERE id=? AND owner_id=? AND type=?', (name, int(groupid), client.db_id, entity_type['group']))
+	EntityNameAndType.discard(int(groupid))
 	respond(context, 'Renamed group %s' % groupid)
 
 @cmd_command(category="Group", privilege_level="registered", syntax="group_id text", no_entity_needed=True)
@@ -2750,6 +2810,7 @@ def fn_changegroupowner(map, client, context, arg):
 	if newowner:
 		c = Database.cursor()
 		c.execute('UPDATE Entity SET owner_id=? WHERE id=? AND owner_id=? AND type=?', (newowner, int(groupid), client.db_id, entity_type['group']))
+		EntityPermissionCache.discard(int(groupid))
 		respond(context, 'Group owner set to \"%s\"' % owner)
 	else:
 		respond(context, 'Nonexistent account', error=True)
@@ -2770,6 +2831,9 @@ def fn_deletegroup(map, client, context, arg):
 		c.execute('DELETE FROM Entity WHERE id=?',        (int(arg),))
 		c.execute('DELETE FROM Group_Member WHERE group_id=?', (int(arg),))
 		c.execute('DELETE FROM Permission WHERE gid=?',   (int(arg),))
+		EntityPermissionCache.discard(int(arg))
+		EntityNameAndType.discard(int(arg))
+		forget_cached_permissions()
 		respond(context, 'Deleted group %s' % arg)
 
 @cmd_command(category="Group", privilege_level="registered", no_entity_needed=True)
@@ -2783,6 +2847,7 @@ def fn_joingroup(map, client, context, arg):
 		if not sql_exists('SELECT member_id from Group_Member WHERE member_id=? AND group_id=?', (client.db_id, int(groupid))):
 			c = Database.cursor()
 			c.execute("INSERT INTO Group_Member (group_id, member_id, flags, accepted_at) VALUES (?, ?, ?, ?)", (int(groupid), client.db_id, 0, datetime.datetime.now(datetime.timezone.utc),))
+			forget_cached_permissions(actor_id=client.db_id)
 			respond(context, 'Joined group %s' % groupid)
 		else:
 			respond(context, 'Already in group %s' % groupid, error=True)
@@ -2795,6 +2860,7 @@ def fn_leavegroup(map, client, context, arg):
 		return
 	c = Database.cursor()
 	c.execute('DELETE FROM Group_Member WHERE group_id=? AND member_id=?', (int(arg), client.db_id,))
+	forget_cached_permissions(actor_id=client.db_id)
 	respond(context, 'Left group %s' % (arg))
 
 @cmd_command(category="Group", privilege_level="registered", no_entity_needed=True)
@@ -2807,6 +2873,7 @@ def fn_kickgroup(map, client, context, arg):
 		if personid:
 			c = Database.cursor()
 			c.execute('DELETE FROM Group_Member WHERE group_id=? AND user_id=?', (int(groupid), personid,))
+			forget_cached_permissions(actor_id=personid)
 			respond(context, 'Kicked \"%s\" from group %s' % (person, groupid))
 		else:
 			respond(context, 'Nonexistent account', error=True)
@@ -2958,6 +3025,10 @@ def fn_scriptstop(map, client, context, arg):
 		return
 	GlobalData['shutdown_scripting_service'](int(arg))
 
+@cmd_command(privilege_level="server_admin", no_entity_needed=True)
+def fn_warmmaps(map, client, context, arg):
+	respond(context, 'Warm maps: %d (%d/%d cells). Warm hits: %d, cold loads: %d, evictions: %d' % (len(WarmMaps), WarmMapCells[0], Config["Server"]["WarmMapCells"], MapLoadStats["warm_hits"], MapLoadStats["cold_loads"], MapLoadStats["evictions"]))
+
 @cmd_command(privilege_level="server_admin", no_entity_needed=True)
 def fn_flushlogs(map, client, context, arg):
 	if ConnectLog:
@@ -3407,6 +3478,15 @@ def fn_entity(map, client, context, arg):
 		# Delete from the database too
 		if e.db_id:
 			c.execute('DELETE FROM Entity WHERE owner_id=? AND id=?', (client.db_id, e.db_id))
+			EntityPermissionCache.discard(e.db_id)
+			EntityNameAndType.discard(e.db_id)
+			forget_cached_permissions(subject_id=e.db_id)
+			if e.is_map():
+				if c.rowcount:
+					# Foreign keys aren't turned on, so the cascade in the schema doesn't do this
+					c.execute('DELETE FROM Map_Chunk WHERE map_id=?', (e.db_id,))
+				forget_neighbor_map(e.db_id)
+				forget_warm_map(e.db_id)
 		if e.map:
 			e.map.remove_from_contents(e)
 		e.save_on_clean_up = False
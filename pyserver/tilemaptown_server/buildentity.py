@@ -14,7 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import asyncio, datetime, json, copy, zlib, random, weakref
+import asyncio, datetime, json, websockets, copy, zlib, random, weakref
 from .buildglobal import *
 from collections import deque
 
@@ -26,11 +26,14 @@ def in_zone(x, y, zone):
 # Allow things that are not entities to do permission checking like entities (like FakeClient)
 class PermissionsMixin(object):
 	def get_allow_deny_for_other_entity(self, other_id):
-		allow = 0
-		deny = 0
 		# If a guest, don't bother looking up any queries
 		if self.db_id == None:
 			return (0, 0)
+		cached = PermissionCache.get((self.db_id, other_id))
+		if cached != None:
+			return cached
+		allow = 0
+		deny = 0
 
 		c = Database.cursor()
 		c.execute('SELECT allow, deny FROM Permission WHERE subject_id=? AND actor_id=?', (other_id, self.db_id,))
@@ -43,6 +46,7 @@ class PermissionsMixin(object):
 		for row in c.execute('SELECT p.allow FROM Permission p, Group_Member m\
 			WHERE m.member_id=? AND p.actor_id=m.group_id AND p.subject_id=? AND m.accepted_at IS NOT NULL', (self.db_id, other_id)):
 			allow |= row[0]
+		PermissionCache.set((self.db_id, other_id), (allow, deny))
 		return (allow, deny)
 
 	# Check if this entity is specifically disallowed from doing something, rather than being disallowed because something uses an allowlist
@@ -53,10 +57,8 @@ class PermissionsMixin(object):
 		if other_id == None:
 			return False
 
-		c = Database.cursor()
-		c.execute('SELECT deny FROM Permission WHERE subject_id=? AND actor_id=?', (other_id, self.db_id,))
-		result = c.fetchone()
-		return result != None and bool(result[0] & perm)
+		# Groups only ever add permissions, so the deny part is the same as in the Permission table
+		return bool(self.get_allow_deny_for_other_entity(other_id)[1] & perm)
 
 	# Entity has permission to act on some other entity
 	def has_permission(self, other, perm=0, default=False):
@@ -129,11 +131,14 @@ class PermissionsMixin(object):
 		other_id = other
 
 		# Get the basic allow/deny/guest_deny
-		c = Database.cursor()
-		c.execute('SELECT allow, deny, guest_deny, owner_id FROM Entity WHERE id=?', (other_id,))
-		result = c.fetchone()
-		if result == None: # Oops, entity doen't even exist
-			return False
+		result = EntityPermissionCache.get(other_id)
+		if result == None:
+			c = Database.cursor()
+			c.execute('SELECT allow, deny, guest_deny, owner_id FROM Entity WHERE id=?', (other_id,))
+			result = c.fetchone()
+			if result == None: # Oops, entity doen't even exist
+				return False
+			EntityPermissionCache.set(other_id, tuple(result))
 		allow = result[0]
 		deny = result[1]
 		guest_deny = result[2]
@@ -190,6 +195,9 @@ class PermissionsMixin(object):
 			allow &= ~perm
 			deny &= ~perm
 
+		# Group permissions apply to every member, so forget everything cached for this subject
+		forget_cached_permissions(subject_id=self.db_id)
+
 		# Delete if all permissions were removed
 		if not (allow | deny):
 			c.execute('DELETE FROM Permission WHERE subject_id=? AND actor_id=?', (self.db_id, actor_id,))
@@ -227,14 +235,15 @@ class Entity(PermissionsMixin, object):
 	contents = None  # set; Entities stored inside this one
 	flags = 0        # Entity flags, like "public"?
 	have_ext = False
+	prefetched_data = None # (data, compressed_data) from prefetch_entity_contents(), while loading
 
 	# Status
 	status_type = None
 	status_message = None
 
 	# Temporary information
-	requests = None      # dict; Indexed by tuple: (username, type). Each item is an array with [timer, id, data]; data may be None. Timer decreases each second, then the request is deleted.
-	rate_limiting = None # dict; Indexed by rate limiting type. Each item is a deque containing (minute, hits)
+	requests = None      # dict; Indexed by tuple: (username, type). Each item is an array with [expiration time, id, data]; data may be None. Expiration time is from time.monotonic(); see expire_request().
+	rate_limiting = None # dict; Indexed by rate limiting type. Each item is a RateLimiter (see buildcommand.py)
 	# valid types include "tpa", "tpahere", "carry", "followme"; see buildcommand.py for more
 	tp_history = None # deque
 
@@ -346,7 +355,7 @@ class Entity(PermissionsMixin, object):
 			if c != None and c.is_client():
 				connection = c.connection()
 				if connection != None and connection.ws != None and connection.can_forward_messages_to:
-					asyncio.ensure_future(connection.ws.send("FWD %s %s" % (self.protocol_id(), make_protocol_message_string(commandType, commandParams))))
+					connection.write_string("FWD %s %s" % (self.protocol_id(), make_protocol_message_string(commandType, commandParams)))
 
 	def send_string(self, raw, is_chat=False):
 		if not self.forward_message_types:
@@ -363,7 +372,7 @@ class Entity(PermissionsMixin, object):
 			if c != None and c.is_client():
 				connection = c.connection()
 				if connection != None and connection.ws != None and connection.can_forward_messages_to:
-					asyncio.ensure_future(connection.ws.send("FWD %s %s" % (self.protocol_id(), raw)))
+					connection.write_string("FWD %s %s" % (self.protocol_id(), raw))
 
 	def start_batch(self):
 		# Only for clients
@@ -379,36 +388,26 @@ class Entity(PermissionsMixin, object):
 		if not remote_only and self.contents:
 			is_chat = command_type == 'MSG' and command_params and 'name' in command_params
 			send_me = make_protocol_message_string(command_type, command_params) # Get the string once and reuse it
+			websocket_list = [] # Connections that can be written to directly, so the message only gets encoded once
 			for client in self.contents:
 				if only_send_if and not only_send_if(client):
 					continue
 				if ignore_user and client.is_client() and in_blocked_username_list(ignore_user, client.connection_attr('ignore_list'), check_action=ignore_action, friends_list=client.connection_attr('watch_list'), recipient=client):
 					continue
-				if require_extension == None:
-					client.send_string(send_me, is_chat=is_chat)
-				elif client.is_client() and client.connection_attr(require_extension):
+				if require_extension != None and not (client.is_client() and client.connection_attr(require_extension)):
+					continue
+				connection = client.connection() if client.is_client() else None
+				websocket = connection.websocket_for_broadcast() if connection else None
+				if websocket != None:
+					websocket_list.append(websocket)
+				else:
 					client.send_string(send_me, is_chat=is_chat)
+			if websocket_list:
+				websockets.broadcast(websocket_list, send_me)
 
 		""" Notify scripts """
-		if mov_user and command_type == "MOV" and self.contents and "from" in command_params and "to" in command_params:
-			fx, fy = command_params['from']
-			tx, ty = command_params['to']
-			dir = command_params.get('dir')
-			callback_type = GlobalData['ScriptingCallbackType']
-
-			for gadget in self.contents:
-				if gadget.entity_type != entity_type['gadget'] or not hasattr(gadget, 'map_watch_zones') or not gadget.map_watch_zones:
-					continue
-				for index, zone in enumerate(gadget.map_watch_zones):
-					is_from = in_zone(fx, fy, zone)
-					is_to = in_zone(tx, ty, zone)
-
-					if is_to and is_from:
-						gadget.receive_zone(mov_user, fx, fy, tx, ty, dir, index, callback_type.MAP_ZONE_MOVE)
-					elif is_to and not is_from:
-						gadget.receive_zone(mov_user, fx, fy, tx, ty, dir, index, callback_type.MAP_ZONE_ENTER)
-					elif not is_to and is_from:
-						gadget.receive_zone(mov_user, fx, fy, tx, ty, dir, index, callback_type.MAP_ZONE_LEAVE)
+		if mov_user and command_type == "MOV":
+			self.notify_watch_zones_of_move(mov_user, command_params)
 
 		# Add remote map on the params if needed, so that linked maps and listeners can see where the message came from
 		do_linked = send_to_links and self.is_map() and self.edge_id_links
@@ -449,6 +448,33 @@ class Entity(PermissionsMixin, object):
 				if require_extension == None or getattr(connection, require_extension):
 					connection.send(command_type, command_params)
 
+	def notify_watch_zones_of_move(self, mov_user, command_params):
+		""" Tell gadgets on this map if a MOV went into, out of, or within one of their watch zones """
+		if self.contents and "from" in command_params and "to" in command_params:
+			fx, fy = command_params['from']
+			tx, ty = command_params['to']
+			dir = command_params.get('dir')
+			callback_type = GlobalData['ScriptingCallbackType']
+
+			for gadget, index, zone in self.watch_zones_near(fx, fy, tx, ty):
+				is_from = in_zone(fx, fy, zone)
+				is_to = in_zone(tx, ty, zone)
+
+				if is_to and is_from:
+					gadget.receive_zone(mov_user, fx, fy, tx, ty, dir, index, callback_type.MAP_ZONE_MOVE)
+				elif is_to and not is_from:
+					gadget.receive_zone(mov_user, fx, fy, tx, ty, dir, index, callback_type.MAP_ZONE_ENTER)
+				elif not is_to and is_from:
+					gadget.receive_zone(mov_user, fx, fy, tx, ty, dir, index, callback_type.MAP_ZONE_LEAVE)
+
+	def watch_zones_near(self, fx, fy, tx, ty):
+		""" (gadget, zone index, zone) for every watch zone that might contain either position """
+		for gadget in self.contents:
+			if gadget.entity_type != entity_type['gadget'] or not hasattr(gadget, 'map_watch_zones') or not gadget.map_watch_zones:
+				continue
+			for index, zone in enumerate(gadget.map_watch_zones):
+				yield (gadget, index, zone)
+
 	# Allow other classes to respond to having things added to them
 
 	def add_to_contents(self, item):
@@ -463,7 +489,7 @@ class Entity(PermissionsMixin, object):
 
 		# Give the item a list of the other stuff in the container it was put in
 		if item.is_client():
-			item.send("WHO", {'list': self.who_contents(), 'you': item.protocol_id()})
+			item.send("WHO", {'list': self.who_contents(viewer=item), 'you': item.protocol_id()})
 
 		# Tell everyone in the container that the new item was added
 		self.broadcast("WHO", {'add': item.who()}, remote_category=maplisten_type['entry'])
@@ -501,6 +527,10 @@ class Entity(PermissionsMixin, object):
 		for parent in self.all_parents():
 			parent.removed_from_child_contents(item)
 
+	def moved_in_contents(self, item):
+		""" Called when move_to() changes the position of something in the contents """
+		pass
+
 	def added_to_child_contents(self, item):
 		""" Called on parents when add_to_contents is called here """
 		pass
@@ -665,6 +695,8 @@ class Entity(PermissionsMixin, object):
 			# Set the new position, and update any passengers
 			self.x = x
 			self.y = y
+			if self.map:
+				self.map.moved_in_contents(self)
 		if self.passengers:
 			# Avoid endless recursion
 			if already_moved == None:
@@ -910,7 +942,7 @@ class Entity(PermissionsMixin, object):
 				out['owner_username'] = owner_username
 		return out
 
-	def who_contents(self):
+	def who_contents(self, viewer=None):
 		""" WHO message data """
 		return {str(e.protocol_id()):e.who() for e in self.contents or tuple()}
 
@@ -990,10 +1022,14 @@ class Entity(PermissionsMixin, object):
 	def load(self, load_id, override_map=None, do_not_switch_map=False):
 		""" Load an entity from the database """
 		c = Database.cursor()
-		c.execute('SELECT type, name, desc, pic, location, position, home_location, home_position, have_ext, owner_id, allow, deny, guest_deny, creator_id FROM Entity WHERE id=?', (load_id,))
-		result = c.fetchone()
-		if result == None:
-			return False
+		prefetched = EntityLoadPrefetch.pop(load_id, None) # Filled in if this is inside something else that's being loaded
+		if prefetched != None:
+			result, prefetched_ext, self.prefetched_data = prefetched
+		else:
+			c.execute('SELECT type, name, desc, pic, location, position, home_location, home_position, have_ext, owner_id, allow, deny, guest_deny, creator_id FROM Entity WHERE id=?', (load_id,))
+			result = c.fetchone()
+			if result == None:
+				return False
 
 		self.assign_db_id(load_id)
 
@@ -1022,9 +1058,11 @@ class Entity(PermissionsMixin, object):
 		# "have_ext" column
 		if result[8]:
 			self.have_ext = result[8]
-			c = Database.cursor()
-			c.execute('SELECT forward_messages_to, tags, compressed_tags, misc, compressed_misc FROM Entity_Ext WHERE id=?', (load_id,))
-			ext_result = c.fetchone()
+			if prefetched != None:
+				ext_result = prefetched_ext
+			else:
+				c.execute('SELECT forward_messages_to, tags, compressed_tags, misc, compressed_misc FROM Entity_Ext WHERE id=?', (load_id,))
+				ext_result = c.fetchone()
 			if ext_result != None:
 				self.forward_messages_to = ext_result[0]
 				self.tags = loads_if_not_none(decompress_entity_data(ext_result[1], ext_result[2]))
@@ -1047,21 +1085,38 @@ class Entity(PermissionsMixin, object):
 			print("Correcting null owner ID for loaded entity %s to %s" % (load_id, self.creator_id))
 			self.owner_id = self.creator_id
 
-		if not self.load_data():
-			return False
+		try:
+			if not self.load_data():
+				return False
+		finally:
+			self.prefetched_data = None
 
-		# Load the contents too
-		c.execute('SELECT id FROM Entity WHERE location=?', (self.db_id,))
-		result = c.fetchall()
-		for child in result:
-			load_child = get_entity_by_id(child[0])
-			if load_child and load_child.map_id == self.db_id:
-				self.add_to_contents(load_child)
+		# Load the contents too; the first entity in a tree gets everything inside it at once
+		contents = EntityContentsPrefetch.pop(self.db_id, None)
+		if contents != None:
+			self.load_contents(contents)
+		else:
+			contents, prefetched_ids = prefetch_entity_contents(self.db_id)
+			try:
+				self.load_contents(contents)
+			finally:
+				# Anything that was already loaded didn't use its rows
+				for db_id in prefetched_ids:
+					EntityLoadPrefetch.pop(db_id, None)
+					EntityContentsPrefetch.pop(db_id, None)
 
 		return True
 
+	def load_contents(self, contents):
+		for child_id in contents:
+			load_child = get_entity_by_id(child_id)
+			if load_child and load_child.map_id == self.db_id:
+				self.add_to_contents(load_child)
+
 	def load_data_as_text(self):
 		""" Get the data and return it as a string """
+		if self.prefetched_data != None:
+			return decompress_entity_data(*self.prefetched_data)
 		return load_text_data_from_db(self.db_id)
 
 	def load_data(self):
@@ -1082,6 +1137,7 @@ class Entity(PermissionsMixin, object):
 		if self.db_id == None:
 			c.execute("INSERT INTO Entity (created_at, creator_id) VALUES (?, ?)", (datetime.datetime.now(datetime.timezone.utc), self.creator_id))
 			self.assign_db_id(c.lastrowid)
+			UsernameByDBId.discard(self.db_id) # In case it was remembered as not existing
 			if self.db_id == None:
 				return
 
@@ -1114,6 +1170,8 @@ class Entity(PermissionsMixin, object):
 
 		values = (self.entity_type, self.name, self.desc, dumps_if_not_none(self.pic), self.map_id, json.dumps([self.x, self.y] + ([self.dir] if self.dir != 2 else [])), self.home_id, dumps_if_not_none(self.home_position), self.owner_id if self.owner_id != None else self.creator_id, self.allow, self.deny, self.guest_deny, self.have_ext, self.db_id)
 		c.execute("UPDATE Entity SET type=?, name=?, desc=?, pic=?, location=?, position=?, home_location=?, home_position=?, owner_id=?, allow=?, deny=?, guest_deny=?, have_ext=? WHERE id=?", values)
+		EntityPermissionCache.discard(self.db_id)
+		EntityNameAndType.set(self.db_id, (self.name, self.entity_type))
 
 		self.save_data()
 
@@ -1133,7 +1191,7 @@ class Entity(PermissionsMixin, object):
 
 	def save_and_commit(self):
 		self.save()
-		Database.commit()
+		commit_database_soon()
 
 	def is_client(self):
 		return False
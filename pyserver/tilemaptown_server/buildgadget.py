@@ -18,7 +18,7 @@ import random, weakref, asyncio
 from collections import deque
 from .buildglobal import *
 from .buildcommand import handle_user_command, send_private_message
-from .buildscripting import send_scripting_message, encode_scripting_message_values, VM_MessageType, ScriptingValueType, ScriptingCallbackType
+from .buildscripting import send_scripting_message, scripting_vm_for, scripting_vm_for_entity, encode_scripting_message_values, VM_MessageType, ScriptingValueType, ScriptingCallbackType
 
 SCRIPT_DEBUG_PRINTS = False
 
@@ -46,6 +46,7 @@ class Gadget(Entity):
 		self.script_data = {}
 		self.script_data_size = 0
 		self.script_running = False
+		self.script_vm = None # ScriptingVM the script was started in
 		self.do_not_load_scripts = do_not_load_scripts
 
 		self.script_callback_enabled = [False] * ScriptingCallbackType.COUNT
@@ -115,11 +116,24 @@ class Gadget(Entity):
 			data['script_data_size'] = self.script_data_size
 		self.save_data_as_text(dumps_if_not_none(data))
 
+	def set_watch_zones(self, zones):
+		""" Replace map_watch_zones, and let the map know its zone index is out of date """
+		self.map_watch_zones = zones
+		if self.map != None and self.map.is_map():
+			self.map.watch_zones_changed()
+
 	def stop_scripts(self):
 		for trait in self.traits:
 			if isinstance(trait, GadgetScript):
 				trait.stop_script()
 
+	def restart_scripts(self):
+		""" Start scripts again after the scripting service process they were running in was replaced """
+		self.script_running = False
+		for trait in self.traits:
+			if isinstance(trait, GadgetScript):
+				trait.start_script()
+
 	def disable_scripts(self):
 		for trait in self.traits:
 			if isinstance(trait, GadgetScript):
@@ -526,7 +540,7 @@ class GadgetRCCar(GadgetTrait):
 				try_x = self.gadget.x + offset[0]
 				try_y = self.gadget.y + offset[1]
 				if try_x >= 0 and try_y >= 0 and try_x < self.gadget.map.width and try_y < self.gadget.map.height:
-					if get_tile_density(self.gadget.map.turfs[try_x][try_y]) or any((get_tile_density(o) for o in (self.gadget.map.objs[try_x][try_y] or []))):
+					if self.gadget.map.is_dense(try_x, try_y):
 						if self.gadget.dir != offset[2]:
 							self.gadget.move_to(self.gadget.x, self.gadget.y, new_dir=offset[2])
 							self.gadget.map.broadcast("MOV", {'id': self.gadget.protocol_id(), 'dir': self.gadget.dir}, remote_category=maplisten_type['move'])
@@ -603,7 +617,7 @@ class GadgetPushable(GadgetTrait):
 	def on_shutdown(self):
 		if not self.gadget:
 			return
-		self.gadget.map_watch_zones = []
+		self.gadget.set_watch_zones([])
 
 	def on_init(self):
 		self.set_zone()
@@ -614,9 +628,9 @@ class GadgetPushable(GadgetTrait):
 		if not self.gadget:
 			return
 		if self.gadget.map == None or not hasattr(self.gadget.map, "width"):
-			self.gadget.map_watch_zones = []
+			self.gadget.set_watch_zones([])
 		else:
-			self.gadget.map_watch_zones = [(0, 0, self.gadget.map.width, self.gadget.map.height)]
+			self.gadget.set_watch_zones([(0, 0, self.gadget.map.width, self.gadget.map.height)])
 
 	def on_zone(self, user, fx, fy, tx, ty, dir, zone_index, callback):
 		if not self.gadget:
@@ -631,7 +645,7 @@ class GadgetPushable(GadgetTrait):
 				new_x = fx
 				new_y = fy
 			elif self.gadget.map and not self.get_config('fly', False) and self.gadget.map.is_map() and self.gadget.map.map_data_loaded:
-				if get_tile_density(self.gadget.map.turfs[new_x][new_y]) or any((get_tile_density(o) for o in (self.gadget.map.objs[new_x][new_y] or []))):
+				if self.gadget.map.is_dense(new_x, new_y):
 					new_x = fx
 					new_y = fy
 			self.gadget.move_to(new_x, new_y)
@@ -1203,7 +1217,7 @@ class GadgetProjectileShooter(GadgetTrait):
 		try_x = start_position.x+offset_x
 		try_y = start_position.y+offset_y
 		if self.get_config('break_wall_hit', False) and try_x >= 0 and try_y >= 0 and start_position.map and try_x < start_position.map.width and try_y < start_position.map.height:
-			if get_tile_density(start_position.map.turfs[try_x][try_y]) or any((get_tile_density(o) for o in (start_position.map.objs[try_x][try_y] or []))):
+			if start_position.map.is_dense(try_x, try_y):
 				return
 
 		# Create the projectile entity and set it up
@@ -1245,7 +1259,7 @@ class GadgetProjectileShooter(GadgetTrait):
 		elif projectile.map and projectile.map.is_map() and projectile.map.map_data_loaded:
 			if try_x >= 0 and try_y >= 0 and try_x < projectile.map.width and try_y < projectile.map.height:
 				if self.get_config('break_wall_hit', False):
-					if get_tile_density(projectile.map.turfs[try_x][try_y]) or any((get_tile_density(o) for o in (projectile.map.objs[try_x][try_y] or []))):
+					if projectile.map.is_dense(try_x, try_y):
 						break_now = True
 			else:
 				break_now = True
@@ -1281,7 +1295,7 @@ class GadgetScript(GadgetTrait):
 			self.usable = True
 
 	def send_scripting_message(self, message_type, other_id=0, status=0, data=None):
-		send_scripting_message(message_type, user_id=self.gadget.owner_id, entity_id=self.gadget.db_id if self.gadget.db_id else -self.gadget.id, other_id=other_id, status=status, data=data)
+		send_scripting_message(message_type, user_id=self.gadget.owner_id, entity_id=self.gadget.db_id if self.gadget.db_id else -self.gadget.id, other_id=other_id, status=status, data=data, vm=scripting_vm_for_entity(self.gadget))
 
 	def send_scripting_values(self, message_type, other_id=0, values=None):
 		self.send_scripting_message(message_type, other_id, status=len(values) if values != None else 0, data=encode_scripting_message_values(values) if values != None else None)
@@ -1313,12 +1327,13 @@ class GadgetScript(GadgetTrait):
 		# Reset script status
 		self.gadget.script_callback_enabled = [False] * ScriptingCallbackType.COUNT
 		self.gadget.listening_to_chat = False
-		self.gadget.map_watch_zones = []
+		self.gadget.set_watch_zones([])
 
 		# OK there's nothing preventing the script from running
 		if SCRIPT_DEBUG_PRINTS:
 			print("Calling start_script() %s" % self.gadget.protocol_id())
 		self.gadget.script_running = True
+		self.gadget.script_vm = scripting_vm_for(self.gadget.owner_id, self.gadget.db_id if self.gadget.db_id else -self.gadget.id)
 		self.send_scripting_message(VM_MessageType.START_SCRIPT)
 		item_id = self.get_config('code_item', None)
 		if item_id:
@@ -14,8 +14,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import sqlite3, json, sys, os.path, weakref, datetime, zlib, re, types
-from collections import deque
+import sqlite3, json, sys, os.path, weakref, datetime, zlib, re, types, asyncio, concurrent.futures, time
+from collections import deque, OrderedDict
 from string import Template
 
 # Config information
@@ -23,6 +23,9 @@ Config = {}
 ConfigFile = 'config.json'
 ServerResources = {}
 LoadedAnyServerResources = [False]
+TilePropertiesByName = {} # Tile name, as it appears in a map -> properties from ServerResources['tilesets']
+DenseTileNames = set()    # Tile names from TilePropertiesByName that are dense
+TileTableVersion = [0]    # Goes up when the tables above are rebuilt, so maps know their density information is out of date
 TempLogs = [None, None, None, None] # Connect, Build, Upload, Rollback info
 
 # Information about the code itself
@@ -33,6 +36,7 @@ available_server_features = {
 	"entity_message_forwarding": {"version": "0.0.1", "minimum_version": "0.0.1"},
 	"user_watch_with_who": {"version": "0.0.1", "minimum_version": "0.0.1"},
 	"message_acknowledgement": {"version": "0.0.1", "minimum_version": "0.0.1"},
+	"map_cache": {"version": "0.0.1", "minimum_version": "0.0.1"},
 }
 server_software_name = "Tilemap Town server"
 server_software_version = "0.2.0"
@@ -50,6 +54,20 @@ def setConfigDefault(group, item, value):
 	if item not in Config[group]:
 		Config[group][item] = value
 
+def compile_tile_tables():
+	""" Flatten ServerResources['tilesets'] into TilePropertiesByName, so looking up a tile by name doesn't need to split it """
+	TilePropertiesByName.clear()
+	DenseTileNames.clear()
+	for tileset_name, tileset in ServerResources.get('tilesets', {}).items():
+		for tile_name, properties in tileset.items():
+			if tileset_name == '':
+				TilePropertiesByName[tile_name] = properties
+			TilePropertiesByName[tileset_name + ':' + tile_name] = properties
+	for name, properties in TilePropertiesByName.items():
+		if isinstance(properties, dict) and properties.get('density', False):
+			DenseTileNames.add(name)
+	TileTableVersion[0] += 1
+
 loadedConfigYet = False
 def loadConfigJson(clearLogs=True):
 	global loadedConfigYet
@@ -91,6 +109,10 @@ def loadConfigJson(clearLogs=True):
 	setConfigDefault("Server",   "MaxEntityWidth", 64)
 	setConfigDefault("Server",   "MaxEntityHeight", 64)
 	setConfigDefault("Server",   "AllowedMusicFileExtensions", [".mod", ".s3m", ".xm", ".it", ".mptm", ".flac", ".mp3", ".ogg", ".opus", ".wav"])
+	setConfigDefault("Server",   "MoveBroadcastRate", 0) # Ticks per second; 0 sends MOV immediately
+	setConfigDefault("Server",   "AreaOfInterestRadius", 20)
+	setConfigDefault("Server",   "WarmMapCells", 1000000)
+	setConfigDefault("Server",   "WarmMapSeconds", 300)
 
 	setConfigDefault("Security", "ProxyOnly",        False)
 	setConfigDefault("Security", "AllowedOrigins",   None)
@@ -158,9 +180,19 @@ def loadConfigJson(clearLogs=True):
 	setConfigDefault("Scripting","Enabled",          False)
 	setConfigDefault("Scripting","ProgramPath",      None)
 	setConfigDefault("Scripting","DataStorageLimit", 0x8000)
+	setConfigDefault("Scripting","EntityQueueLimit", 0x10000)
+	setConfigDefault("Scripting","ProcessCount",     1)
 
 	setConfigDefault("Database", "File",             "town.db")
 	setConfigDefault("Database", "Setup",            True)
+	setConfigDefault("Database", "WAL",              True)
+	setConfigDefault("Database", "CommitInterval",   5)
+	setConfigDefault("Database", "CommitBatchSize",  500)
+	setConfigDefault("Database", "CheckpointInterval", 60)
+	setConfigDefault("Database", "CachedStatements", 256)
+	setConfigDefault("Database", "PermissionCacheSize", 4096)
+	setConfigDefault("Database", "DirectoryCacheSize", 8192)
+	setConfigDefault("Database", "NeighborMapCacheSize", 128)
 	setConfigDefault("Images",   "URLWhitelist",     ["https://file.garden/", "https://i.postimg.cc/", "https://i.ibb.co/"])
 	setConfigDefault("Logs",     "ConnectFile",      "")
 	setConfigDefault("Logs",     "BuildFile",        "")
@@ -228,6 +260,8 @@ def loadConfigJson(clearLogs=True):
 						url = ServerResources["doodle_board_tilesets"][i][j]
 						if not url.startswith("http://") and not url.startswith("https://"):
 							ServerResources["doodle_board_tilesets"][i][j] = base + url
+	compile_tile_tables()
+
 	if Config["MapPage"]["TemplateFile"] and os.path.isfile(Config["MapPage"]["TemplateFile"]):
 		with open(Config["MapPage"]["TemplateFile"], encoding="utf-8") as f:
 			Config["MapPage"]["Template"] = Template(f.read())
@@ -258,10 +292,136 @@ loadConfigJson()
 GlobalData = {}
 
 # Open database connection
-Database = sqlite3.connect(Config["Database"]["File"], detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+Database = sqlite3.connect(Config["Database"]["File"], detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES, cached_statements=Config["Database"]["CachedStatements"])
 DatabaseMeta = {}
+DatabaseCommitInfo = [0] # Database.total_changes as of the last commit
+
+if Config["Database"]["WAL"]:
+	# Commits only append to the log without syncing; the syncing happens when checkpointing, which the writer thread does
+	Database.execute("PRAGMA journal_mode=WAL")
+	Database.execute("PRAGMA synchronous=NORMAL")
+	Database.execute("PRAGMA wal_autocheckpoint=0")
+
+# Separate thread (with its own connection) for database work that shouldn't block the event loop
+DatabaseWriter = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="DatabaseWriter")
+DatabaseWriterConnection = [None]
+
+def checkpoint_database():
+	""" Copy the write-ahead log into the database file; runs on the DatabaseWriter thread """
+	if DatabaseWriterConnection[0] == None:
+		DatabaseWriterConnection[0] = sqlite3.connect(Config["Database"]["File"])
+	return DatabaseWriterConnection[0].execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+
+def close_database_writer():
+	""" Finish anything the writer thread is doing, then close its connection """
+	def close_connection():
+		if DatabaseWriterConnection[0] != None:
+			DatabaseWriterConnection[0].close()
+			DatabaseWriterConnection[0] = None
+	DatabaseWriter.submit(close_connection).result()
+	DatabaseWriter.shutdown(wait=True)
+
+# Another thread for reads that can be done in the background, like maps that are only being shown to clients and not loaded
+DatabaseReader = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="DatabaseReader")
+DatabaseReaderConnection = [None]
+
+def database_reader_connection():
+	""" Connection for the DatabaseReader thread to use; it can only see committed changes """
+	if DatabaseReaderConnection[0] == None:
+		DatabaseReaderConnection[0] = sqlite3.connect(Config["Database"]["File"])
+	return DatabaseReaderConnection[0]
+
+def close_database_reader():
+	""" Finish anything the reader thread is doing, then close its connection """
+	def close_connection():
+		if DatabaseReaderConnection[0] != None:
+			DatabaseReaderConnection[0].close()
+			DatabaseReaderConnection[0] = None
+	DatabaseReader.submit(close_connection).result()
+	DatabaseReader.shutdown(wait=True)
+
+def commit_database():
+	""" Commit any pending writes now """
+	if Database.in_transaction:
+		Database.commit()
+	DatabaseCommitInfo[0] = Database.total_changes
+	MapsSavedSinceCommit.clear()
+
+def commit_database_soon():
+	""" Use instead of Database.commit() for writes that can wait a few seconds; main_timer commits them in a batch """
+	if Config["Database"]["CommitInterval"] <= 0 or (Database.total_changes - DatabaseCommitInfo[0]) >= Config["Database"]["CommitBatchSize"]:
+		commit_database()
 
 # Open logs
+class BoundedCache(object):
+	""" Dictionary that forgets the least recently used keys once it gets too big """
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.data = OrderedDict()
+
+	def get(self, key, default=None):
+		value = self.data.get(key, default)
+		if key in self.data:
+			self.data.move_to_end(key)
+		return value
+
+	def set(self, key, value):
+		self.data[key] = value
+		self.data.move_to_end(key)
+		while len(self.data) > self.max_size:
+			self.data.popitem(last=False)
+
+	def discard(self, key):
+		self.data.pop(key, None)
+
+	def discard_if(self, condition):
+		for key in [key for key in self.data if condition(key)]:
+			del self.data[key]
+
+	def clear(self):
+		self.data.clear()
+
+# Results of permission queries, so they don't need to be looked up every time
+PermissionCache = BoundedCache(Config["Database"]["PermissionCacheSize"])       # (actor_id, subject_id): (allow, deny) from Permission, with group allows included
+EntityPermissionCache = BoundedCache(Config["Database"]["PermissionCacheSize"]) # subject_id: (allow, deny, guest_deny, owner_id) for entities that aren't loaded
+
+# Usernames, names and types for database IDs; None is cached too, for things that don't exist
+NotCached = object()
+UsernameByDBId = BoundedCache(Config["Database"]["DirectoryCacheSize"])      # entity_id: username
+DBIdByUsername = BoundedCache(Config["Database"]["DirectoryCacheSize"])      # username: entity_id
+EntityNameAndType = BoundedCache(Config["Database"]["DirectoryCacheSize"])   # id: (name, type)
+
+# MAI and MAP for maps that aren't loaded but are being shown to clients as edge-linked neighbors
+NeighborMapCache = BoundedCache(Config["Database"]["NeighborMapCacheSize"]) # map db_id: (MAI without owner_username, MAP JSON text, content version)
+NeighborMapCacheGeneration = [0] # Goes up whenever something is forgotten, so reads that started before then don't get cached
+MapsSavedSinceCommit = set()      # Maps whose changes the DatabaseReader thread can't see yet
+
+def forget_neighbor_map(db_id):
+	""" Call when a map's information in the database changes """
+	NeighborMapCache.discard(db_id)
+	NeighborMapCacheGeneration[0] += 1
+	MapsSavedSinceCommit.add(db_id)
+
+def remember_username(db_id, username):
+	""" Call when a user's username is set, so the directory cache stays correct """
+	old_username = UsernameByDBId.get(db_id)
+	if old_username != None and old_username != username:
+		DBIdByUsername.discard(old_username.lower())
+	UsernameByDBId.set(db_id, username)
+	if username != None:
+		DBIdByUsername.set(username.lower(), db_id)
+
+def forget_cached_permissions(actor_id=None, subject_id=None):
+	""" Call when the Permission or Group_Member tables change for this actor or subject """
+	if actor_id != None and subject_id != None:
+		PermissionCache.discard((actor_id, subject_id))
+	elif actor_id != None:
+		PermissionCache.discard_if(lambda key: key[0] == actor_id)
+	elif subject_id != None:
+		PermissionCache.discard_if(lambda key: key[1] == subject_id)
+	else:
+		PermissionCache.clear()
+
 ConnectLog = None
 if len(Config["Logs"]["ConnectFile"]):
 	ConnectLog = open(Config["Logs"]["ConnectFile"], 'a', encoding="utf-8")
@@ -288,8 +448,10 @@ AllConnections  = weakref.WeakSet()             # All connections, regardless of
 AllMaps         = weakref.WeakSet()             # Maps only; used by /whereare
 AllEntitiesByDB = weakref.WeakValueDictionary() # All entities (indexed by database ID)
 AllEntitiesByID = weakref.WeakValueDictionary() # All entities (indexed by temporary ID)
-AllEntitiesWithRequests = weakref.WeakSet()     # All entities with active requests
-AllEntitiesWithRateLimiting = weakref.WeakSet() # All entities with rate limiting information
+MapsWithPendingMoves = weakref.WeakSet()        # Maps with MOV messages waiting for the next move tick
+WarmMaps = OrderedDict()                        # Maps nobody is on that are being kept loaded; db_id: (map, cells, time emptied), oldest first
+WarmMapCells = [0]                              # Total width*height of everything in WarmMaps
+MapLoadStats = {"warm_hits": 0, "cold_loads": 0, "evictions": 0}
 ConnectionsByUsername = weakref.WeakValueDictionary() # Look up connections by lowercased username
 ConnectionsByApiKey = weakref.WeakValueDictionary() # Look up connections by API key (supplied to clients in IDN)
 OfflineMessages = {} # OfflineMessages[recipient_id][sender_id][index]
@@ -361,6 +523,7 @@ mapflag = {}
 mapflag['public'] = 1
 mapflag['build_logs'] = 2
 mapflag['no_build_logs'] = 4
+mapflag['nearby_only'] = 8 # Only tell clients about entities near them
 
 # User flags
 userflag = {}
@@ -415,6 +578,15 @@ global_entity_marker = "!"
 creatable_entity_types = ('text', 'image', 'map_tile', 'tileset', 'reference', 'folder', 'landmark', 'generic', 'chatroom', 'gadget', 'client_data')
 
 # Important shared functions
+def call_later_weakly(delay, callback, target, *args):
+	""" Like loop.call_later(), but only keeps a weak reference to target, and skips callback(target, *args) if it's gone by then """
+	target_ref = weakref.ref(target)
+	def run():
+		target = target_ref()
+		if target != None:
+			callback(target, *args)
+	return asyncio.get_event_loop().call_later(delay, run)
+
 def is_entity(e):
 	return isinstance(e, Entity)
 
@@ -454,39 +626,52 @@ def find_connection_by_username(username):
 	return ConnectionsByUsername.get(username.lower(), None)
 
 def find_username_by_db_id(dbid):
+	username = UsernameByDBId.get(dbid, NotCached)
+	if username is not NotCached:
+		return username
 	c = Database.cursor()
 	c.execute('SELECT username FROM User WHERE entity_id=?', (dbid,))
 	result = c.fetchone()
-	if result == None:
-		return None
-	return result[0]
+	username = result[0] if result != None else None
+	UsernameByDBId.set(dbid, username)
+	return username
 
 def find_db_id_by_username(username):
 	if valid_id_format(username):
 		return int_if_numeric(username)
-	c = Database.cursor()
 	username = str(username).lower()
+	db_id = DBIdByUsername.get(username, NotCached)
+	if db_id is not NotCached:
+		return db_id
+	c = Database.cursor()
 	c.execute('SELECT entity_id FROM User WHERE username=?', (username,))
 	result = c.fetchone()
-	if result == None:
-		return None
-	return result[0]
-
-def get_entity_type_by_db_id(id):
+	db_id = result[0] if result != None else None
+	DBIdByUsername.set(username, db_id)
+	return db_id
+
+def get_entity_name_and_type_by_db_id(id):
+	name_and_type = EntityNameAndType.get(id, NotCached)
+	if name_and_type is not NotCached:
+		return name_and_type
 	c = Database.cursor()
-	c.execute('SELECT type FROM Entity WHERE id=?', (id,))
+	c.execute('SELECT name, type FROM Entity WHERE id=?', (id,))
 	result = c.fetchone()
-	if result == None:
+	name_and_type = tuple(result) if result != None else None
+	EntityNameAndType.set(id, name_and_type)
+	return name_and_type
+
+def get_entity_type_by_db_id(id):
+	name_and_type = get_entity_name_and_type_by_db_id(id)
+	if name_and_type == None:
 		return None
-	return result[0]
+	return name_and_type[1]
 
 def get_entity_name_by_db_id(id):
-	c = Database.cursor()
-	c.execute('SELECT name FROM Entity WHERE id=?', (id,))
-	result = c.fetchone()
-	if result == None:
+	name_and_type = get_entity_name_and_type_by_db_id(id)
+	if name_and_type == None:
 		return None
-	return result[0]
+	return name_and_type[0]
 
 def find_db_id_by_str(id): # Generic; recognize and handle different prefixes
 	# Can use a global entity ID; look up what the actual entity ID is
@@ -520,6 +705,49 @@ def entity_id_exists(id):
 		return int(id[1:]) in AllEntitiesByID
 	return False
 
+# .-----------------------------------------------------------------------------
+# | Maps kept loaded after everyone leaves, so coming back soon doesn't need a save and reload
+# '-----------------------------------------------------------------------------
+
+def keep_map_warm(map):
+	""" Hold onto a map that just became empty, instead of saving and unloading it right away """
+	forget_warm_map(map.db_id)
+	cells = map.width * map.height
+	WarmMaps[map.db_id] = (map, cells, time.time())
+	WarmMapCells[0] += cells
+	while WarmMaps and WarmMapCells[0] > Config["Server"]["WarmMapCells"]:
+		evict_warm_map(next(iter(WarmMaps)))
+
+def forget_warm_map(db_id):
+	""" Stop keeping a map warm without saving or unloading it; returns True if it was warm """
+	warm = WarmMaps.pop(db_id, None)
+	if warm == None:
+		return False
+	WarmMapCells[0] -= warm[1]
+	return True
+
+def evict_warm_map(db_id):
+	""" Save a warm map and unload its data """
+	map = WarmMaps[db_id][0]
+	forget_warm_map(db_id)
+	MapLoadStats["evictions"] += 1
+	if map.user_count == 0 and map.map_data_loaded:
+		map.save_data()
+		map.unload_data()
+
+def expire_warm_maps():
+	""" Evict maps that have been warm for longer than Server.WarmMapSeconds """
+	oldest_allowed = time.time() - Config["Server"]["WarmMapSeconds"]
+	while WarmMaps:
+		db_id, (map, cells, emptied_at) = next(iter(WarmMaps.items()))
+		if emptied_at > oldest_allowed:
+			break
+		evict_warm_map(db_id)
+
+def evict_all_warm_maps():
+	while WarmMaps:
+		evict_warm_map(next(iter(WarmMaps)))
+
 def get_entity_by_id(id, load_from_db=True, do_not_load_scripts=False):
 	# If it's temporary, get it if it still exists
 	if isinstance(id, str):
@@ -724,7 +952,7 @@ def set_database_meta(key, value):
 	else:
 		c.execute("UPDATE Meta SET value=?, flags=? WHERE item=?", (value, flags, key,))
 	DatabaseMeta[key] = value
-	Database.commit()
+	commit_database_soon()
 
 def reload_database_meta():
 	c = Database.cursor()
@@ -735,6 +963,33 @@ def reload_database_meta():
 			v = int(v)
 		DatabaseMeta[row[0]] = v
 
+# Secondary indexes the database should have; created by database_setup_v4.py
+# Index name: (table, columns)
+database_indexes = {
+	"Entity_location":            ("Entity",            ("location",)),                            # Loading an entity's contents
+	"Entity_owner_id":            ("Entity",            ("owner_id",)),                            # Listing someone's entities
+	"User_username":              ("User",              ("username",)),                            # find_db_id_by_username()
+	"Permission_subject_actor":   ("Permission",        ("subject_id", "actor_id", "allow", "deny")), # get_allow_deny_for_other_entity(), covering
+	"Permission_actor_id":        ("Permission",        ("actor_id",)),                            # Cleaning up after deleted entities
+	"Group_Member_member_id":     ("Group_Member",      ("member_id", "accepted_at", "group_id")), # Groups a user is in, covering
+	"Mail_owner_id":              ("Mail",              ("owner_id",)),                            # Sending mail on login
+	"Global_Entity_Key_key":      ("Global_Entity_Key", ("key",)),                                 # find_db_id_by_str()
+	"User_Profile_user_id":       ("User_Profile",      ("user_id",)),
+	"User_File_Upload_user_id":   ("User_File_Upload",  ("user_id",)),
+	"User_File_Folder_user_id":   ("User_File_Folder",  ("user_id",)),
+	"Server_Ban_ip":              ("Server_Ban",        ("ip",)),
+}
+
+def check_database_indexes():
+	""" Print a warning about any index from database_indexes that the database doesn't have; returns the missing names """
+	c = Database.cursor()
+	c.execute("SELECT name FROM sqlite_master WHERE type='index'")
+	have = set(row[0] for row in c.fetchall())
+	missing = [name for name in database_indexes if name not in have]
+	if missing:
+		print("Database is missing indexes: %s (run with Database.Setup enabled to create them)" % ", ".join(missing))
+	return missing
+
 def string_is_int(s):
 	if len(s) == 0:
 		return False
@@ -810,6 +1065,51 @@ def load_text_data_from_db(entity_id):
 		return decompress_entity_data(result[0], result[1])
 	return None
 
+# Rows for everything inside an entity that's being loaded, fetched together by prefetch_entity_contents() and used up by Entity.load()
+EntityLoadPrefetch = {}     # db_id: (Entity row, Entity_Ext row or None, (data, compressed_data) or None for maps)
+EntityContentsPrefetch = {} # db_id: [db_ids of the entities inside it]
+
+def prefetch_entity_contents(root_id):
+	""" Get every entity inside root_id, recursively, with three queries total instead of several for each entity.
+	Returns (the IDs directly inside root_id, all of the IDs that were prefetched) """
+	c = Database.cursor()
+	c.execute('''WITH RECURSIVE Contents(id, type) AS (
+			SELECT id, type FROM Entity WHERE location=?
+			UNION SELECT Entity.id, Entity.type FROM Entity, Contents WHERE Entity.location=Contents.id AND Contents.type!=?
+		)
+		SELECT Entity.id, Entity.type, name, desc, pic, location, position, home_location, home_position, have_ext, owner_id, allow, deny, guest_deny, creator_id,
+			CASE WHEN Entity.type=? THEN NULL ELSE data END, CASE WHEN Entity.type=? THEN NULL ELSE compressed_data END
+		FROM Contents JOIN Entity ON Entity.id=Contents.id ORDER BY Entity.id''', (root_id, entity_type['user'], entity_type['map'], entity_type['map']))
+	rows = c.fetchall()
+	if not rows:
+		return ([], [])
+
+	# Users are only there so that their types get cached; they can't be loaded by ID and their contents get loaded when they log in
+	ext_ids = [row[0] for row in rows if row[9] and row[1] != entity_type['user']]
+	ext_rows = {}
+	for i in range(0, len(ext_ids), 500):
+		some_ids = ext_ids[i:i+500]
+		c.execute('SELECT id, forward_messages_to, tags, compressed_tags, misc, compressed_misc FROM Entity_Ext WHERE id IN (%s)' % ','.join('?' * len(some_ids)), some_ids)
+		for ext_row in c.fetchall():
+			ext_rows[ext_row[0]] = ext_row[1:]
+
+	root_contents = []
+	prefetched_ids = []
+	for row in rows:
+		db_id, location = row[0], row[5]
+		EntityNameAndType.set(db_id, (row[2], row[1]))
+		if location == root_id:
+			root_contents.append(db_id)
+		if row[1] == entity_type['user']:
+			continue
+		EntityLoadPrefetch[db_id] = (row[1:15], ext_rows.get(db_id), (row[15], row[16]) if row[1] != entity_type['map'] else None)
+		EntityContentsPrefetch.setdefault(db_id, [])
+		prefetched_ids.append(db_id)
+	for row in rows:
+		if row[5] in EntityContentsPrefetch and row[5] != root_id:
+			EntityContentsPrefetch[row[5]].append(row[0])
+	return (root_contents, prefetched_ids)
+
 def text_from_text_item(entity_id):
 	if isinstance(entity_id, str):
 		entity_id = find_db_id_by_str(entity_id)
@@ -832,25 +1132,36 @@ def get_tile_properties(name):
 		return name
 	if name == None:
 		return None
+	properties = TilePropertiesByName.get(name)
+	if properties != None or name.count(':') < 2:
+		return properties
+	# Anything after a second colon is ignored
 	s = name.split(':')
-	if len(s) == 1:
-		tileset = ''
-		tilename = s[0]
-	else:
-		tileset = s[0]
-		tilename = s[1]
-
-	tileset = ServerResources['tilesets'].get(tileset)
-	if tileset == None:
-		return None
-	return tileset.get(tilename)
+	return TilePropertiesByName.get(s[0] + ':' + s[1])
 
 def get_tile_density(name):
+	if isinstance(name, str):
+		if name in DenseTileNames:
+			return True
+		if name in TilePropertiesByName or name.count(':') < 2:
+			return False
+		# Anything after a second colon is ignored, like in get_tile_properties()
+		s = name.split(':')
+		return (s[0] + ':' + s[1]) in DenseTileNames
 	properties = get_tile_properties(name)
 	if properties == None:
 		return False
 	return properties.get('density', False)
 
+def get_objs_density(objs):
+	""" True if any tile in an obj list is dense """
+	if not objs:
+		return False
+	for o in objs:
+		if get_tile_density(o):
+			return True
+	return False
+
 def in_blocked_username_list(client, banlist, display_action=None, check_action="", friends_list=None, recipient=None):
 	if client is recipient:
 		return False
@@ -14,16 +14,51 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json, asyncio, random, datetime
+import json, asyncio, random, datetime, struct, time, gzip
 from .buildglobal import *
 from .buildentity import Entity
+from .buildtilegrid import TileGrid, MapBlob, encode_map_blob, encode_map_chunk, is_map_blob, map_chunk_index, map_chunk_indexes_in, map_chunk_rectangles
+
+# Put in Entity.data to mark that Entity.compressed_data holds a binary map (see buildtilegrid.py) instead of compressed JSON
+map_blob_data_marker = 'tmtmap'
+watch_zone_cell_size = 16
+map_content_history_length = 32 # How many content versions back a map_cache client can get just the changed chunks for
 
 # Unused currently
 DirX = [ 1,  1,  0, -1, -1, -1,  0,  1]
 DirY = [ 0,  1,  1,  1,  0, -1, -1, -1]
 
-def temporarily_load_map_from_db(db_id, user=None):
-	c = Database.cursor()
+def load_map_data_from_db(db_id, db=None):
+	""" Returns a MapBlob for maps saved in the binary format, a dictionary for maps saved as JSON, or None """
+	c = (db or Database).cursor()
+	c.execute('SELECT data, compressed_data FROM Entity WHERE id=?', (db_id,))
+	result = c.fetchone()
+	if result == None:
+		return None
+	if result[0] == map_blob_data_marker and is_map_blob(result[1]):
+		try:
+			blob = MapBlob(result[1])
+		except (ValueError, struct.error) as err:
+			print("Bad binary map data for %s: %s" % (db_id, err))
+			return None
+		if blob.uses_chunk_table:
+			c.execute('SELECT chunk_index, data FROM Map_Chunk WHERE map_id=?', (db_id,))
+			blob.chunk_rows = dict(c.fetchall())
+		return blob
+	return loads_if_not_none(decompress_entity_data(result[0], result[1]))
+
+def map_data_section_from_db(map_data, default_turf):
+	""" Takes what load_map_data_from_db() returned and gives back (extra data like edge links, MAP message data for the whole map) """
+	if isinstance(map_data, MapBlob):
+		turfs, objs = map_data.section(0, 0, map_data.width-1, map_data.height-1)
+		return (map_data.extra, {'pos': [0, 0, map_data.width-1, map_data.height-1], 'default': default_turf, 'turf': turfs, 'obj': objs})
+	return (map_data, {'pos': map_data['pos'], 'default': map_data['default'], 'turf': map_data['turf'], 'obj': map_data['obj']})
+
+def read_map_snapshot(db_id):
+	""" Read a map that isn't loaded, for showing to clients. Runs on the DatabaseReader thread, so it only touches the database.
+	Returns (MAI without owner_username, MAP JSON text, content version) or None """
+	db = database_reader_connection()
+	c = db.cursor()
 
 	c.execute('SELECT type, name, desc, owner_id, allow, deny, guest_deny FROM Entity WHERE id=?', (db_id,))
 	entity_table_data = c.fetchone()
@@ -42,10 +77,11 @@ def temporarily_load_map_from_db(db_id, user=None):
 		except:
 			map_default_turf = "grass"
 
-	map_entity_data = loads_if_not_none(load_text_data_from_db(db_id))
+	map_entity_data = load_map_data_from_db(db_id, db)
 	if map_entity_data == None:
 		print("Bad map data for %s" % db_id)
 		return None
+	map_entity_data, map = map_data_section_from_db(map_entity_data, map_default_turf)
 
 	###############
 
@@ -54,7 +90,6 @@ def temporarily_load_map_from_db(db_id, user=None):
 		'desc': entity_desc,
 		'id': db_id,
 		'owner_id': entity_owner_id,
-		'owner_username': find_username_by_db_id(entity_owner_id) or '?',
 		'default': map_default_turf,
 		'size': [map_width, map_height],
 		'public': map_flags & mapflag['public'] != 0,
@@ -65,15 +100,57 @@ def temporarily_load_map_from_db(db_id, user=None):
 		'default_allow': permission_list_from_bitfield(entity_allow),
 		'default_deny': permission_list_from_bitfield(entity_deny)
 	}
-	#if user:
-	#	mai['you_allow'] = permission_list_from_bitfield(entity_allow)
-	#	mai['you_deny'] = permission_list_from_bitfield(entity_deny)
 	if "wallpaper" in map_entity_data:
 		mai['wallpaper'] = map_entity_data["wallpaper"]
 
-	map = {'pos': map_entity_data['pos'], 'default': map_entity_data['default'], 'turf': map_entity_data['turf'], 'obj': map_entity_data['obj']}
-
-	return (mai, map)
+	return (mai, json.dumps(map, separators=(',', ':')), map_entity_data.get("content_version"))
+
+def read_map_snapshots(map_ids):
+	return [read_map_snapshot(map_id) for map_id in map_ids]
+
+def send_map_snapshot(connection, map_id, snapshot):
+	""" Send the MAI and MAP for an edge-linked map that isn't loaded, from a read_map_snapshot() result """
+	mai, map_text, version = snapshot
+	mai = dict(mai)
+	mai['owner_username'] = find_username_by_db_id(mai['owner_id']) or '?'
+	mai['remote_map'] = map_id
+	extra_fields = ',"remote_map":%s}' % json.dumps(map_id)
+	if connection.caches_maps and version != None:
+		mai['content_version'] = version
+		if connection.cached_map_versions.get(str(map_id)) == version:
+			mai['map_cache'] = 'unchanged'
+			connection.send("MAI", mai)
+			return
+		mai['map_cache'] = 'full'
+		connection.cached_map_versions[str(map_id)] = version
+		extra_fields = ',"remote_map":%s,"content_version":%d}' % (json.dumps(map_id), version)
+	connection.send("MAI", mai)
+	connection.send_string("MAP " + map_text[:-1] + extra_fields)
+
+async def send_neighbor_maps_later(connection, map_ids):
+	""" Read edge-linked maps on the DatabaseReader thread, and send them to the client once they're ready """
+	if not MapsSavedSinceCommit.isdisjoint(map_ids):
+		commit_database() # The reader only sees committed data; otherwise leave the commit to main_timer's batching
+	generation = NeighborMapCacheGeneration[0]
+	snapshots = await asyncio.get_running_loop().run_in_executor(DatabaseReader, read_map_snapshots, map_ids)
+
+	connection.start_batch()
+	for map_id, snapshot in zip(map_ids, snapshots):
+		if snapshot == None:
+			continue
+		if generation == NeighborMapCacheGeneration[0]:
+			NeighborMapCache.set(map_id, snapshot)
+		# Don't send it if the client has moved somewhere the map isn't linked from anymore
+		if connection.ws == None or map_id not in connection.loaded_maps:
+			continue
+		linked_map = AllEntitiesByDB.get(map_id)
+		if linked_map and linked_map.is_map() and linked_map.map_data_loaded: # Got loaded in the meantime
+			mai = linked_map.map_info()
+			mai['remote_map'] = map_id
+			linked_map.send_map_data(connection, mai, remote_map=map_id)
+		else:
+			send_map_snapshot(connection, map_id, snapshot)
+	connection.finish_batch()
 
 class Map(Entity):
 	def __init__(self,width=100,height=100,id=None,creator_id=None):
@@ -92,12 +169,40 @@ class Map(Entity):
 		self.user_count = 0
 		self.map_data_loaded = False
 		self.map_data_modified = False
+		self.dirty_map_chunks = set()  # Chunks changed since the last save (see map_chunk_index)
+		self.map_chunks_in_db = False  # True if the Map_Chunk table is up to date except for dirty_map_chunks
 		self.topic = None
 		self.topic_username = None
 
+		# MOV messages waiting for the next move tick, if Server.MoveBroadcastRate is set
+		self.pending_moves = []       # Message parameters, in the order they'll be sent
+		self.pending_move_index = {}  # Entity protocol ID -> index in pending_moves that can still be merged into
+
+		# Index of gadgets' map_watch_zones, so moves only check the zones near them
+		self.watch_zone_index = None  # (cell x, cell y) -> list of (gadget, zone index, zone); rebuilt when None
+		self.watch_zones_outside = [] # Zones that reach past the map edge, for positions outside the map
+
+		# Area of interest information, if mapflag['nearby_only'] is set (see uses_area_of_interest)
+		self.aoi_grid = None  # (cell x, cell y) -> set of entities in that cell
+		self.aoi_cell = {}    # entity -> (cell x, cell y)
+		self.aoi_seen = {}    # client -> set of entities the client has been told about, not counting itself
+		self.aoi_seen_by = {} # entity -> set of clients that have been told about it
+
 		# See also:
-		# self.turfs[x][y]
-		# self.objs[x][y]
+		# self.turfs - TileGrid, use get_turf() and put_turf()
+		# self.objs  - TileGrid, use get_objs() and put_objs()
+		# Content versions for the map_cache extension; see observe_content_version()
+		self.content_version = 0
+		self.content_changes = None    # Chunks changed since content_version was given out, or None if the whole map changed
+		self.content_history = []      # [(version, chunks that changed to make that version), ...], oldest first
+		self.content_history_base = 0  # Version that content_history starts from
+
+		# Whole map MAP data encoded as JSON, shared by everyone that needs it; see map_data_json()
+		self.map_data_json_cache = None # (default turf it was made with, JSON text)
+		self.map_data_gzip_cache = None # gzip compressed {"data": JSON text} for the API
+
+		self.density = None     # bytearray with a 1 for each dense cell, in the same order as TileGrid cells; built by is_dense() when needed
+		self.density_version = 0 # TileTableVersion that the density was built with
 
 		self.edge_id_links  = None
 
@@ -113,13 +218,252 @@ class Map(Entity):
 
 	def clean_up(self):
 		""" Clean up everything before a map unload """
+		self.pending_moves = []
+		self.pending_move_index = {}
+		self.stop_area_of_interest()
 		super().clean_up()
 
+	def broadcast(self, command_type, command_params, remote_category=None, remote_only=False, send_to_links=False, require_extension=None, only_send_if=None, mov_user=None, ignore_user=None, ignore_action="chat"):
+		""" Send a message to everyone on the map, holding onto plain MOV messages until the next move tick """
+		if command_type == "MOV" and Config["Server"]["MoveBroadcastRate"] > 0 and remote_category == maplisten_type['move'] \
+			and not (remote_only or send_to_links or require_extension or only_send_if or ignore_user):
+			if mov_user:
+				self.notify_watch_zones_of_move(mov_user, command_params)
+			self.queue_move(command_params)
+			return
+		# Anything else has to go out after the moves that came before it
+		if self.pending_moves:
+			self.send_pending_moves()
+		only_send_if = self.area_of_interest_filter(command_type, command_params, only_send_if)
+		super().broadcast(command_type, command_params, remote_category=remote_category, remote_only=remote_only, send_to_links=send_to_links, require_extension=require_extension, only_send_if=only_send_if, mov_user=mov_user, ignore_user=ignore_user, ignore_action=ignore_action)
+
+	def queue_move(self, command_params):
+		""" Add a MOV to the next move tick, combining it with the entity's last queued MOV if that won't lose anything """
+		entity_id = command_params.get('id')
+		index = self.pending_move_index.get(entity_id)
+		if index != None:
+			pending = self.pending_moves[index]
+			merged = dict(pending)
+			merged.update(command_params)
+			if 'from' in pending:
+				merged['from'] = pending['from']
+			elif 'to' in pending:
+				merged.pop('from', None) # Started with a teleport, so the combined move is one too
+			self.pending_moves[index] = merged
+		else:
+			self.pending_moves.append(command_params)
+			index = len(self.pending_moves) - 1
+
+		# Followers walk along the leader's path, so every step with a "from" has to reach clients separately
+		entity = get_entity_by_id(entity_id, load_from_db=False) if entity_id != None else None
+		if entity != None and 'from' in command_params and any(passenger.is_following for passenger in (entity.passengers or ())):
+			self.pending_move_index.pop(entity_id, None)
+		else:
+			self.pending_move_index[entity_id] = index
+		MapsWithPendingMoves.add(self)
+
+	def send_pending_moves(self):
+		""" Send the queued MOV messages, as one batch per recipient """
+		moves = self.pending_moves
+		self.pending_moves = []
+		self.pending_move_index = {}
+		MapsWithPendingMoves.discard(self)
+		if not moves:
+			return
+
+		listeners = tuple(MapListens[maplisten_type['move']].get(self.protocol_id(), ()))
+		for recipient in self.contents or ():
+			recipient.start_batch()
+		for connection in listeners:
+			connection.start_batch()
+		for command_params in moves:
+			super().broadcast("MOV", command_params, remote_category=maplisten_type['move'], only_send_if=self.area_of_interest_filter("MOV", command_params))
+		for recipient in self.contents or ():
+			recipient.finish_batch()
+		for connection in listeners:
+			connection.finish_batch()
+
 	def add_to_contents(self, item):
 		if item.is_client():
 			self.user_count += 1
+			if self.user_count == 1 and forget_warm_map(self.db_id):
+				MapLoadStats["warm_hits"] += 1
 			# Don't load data here; wait until send_map_info()
 		super().add_to_contents(item)
+		if getattr(item, 'map_watch_zones', None):
+			self.watch_zones_changed()
+		self.moved_in_contents(item)
+
+	def watch_zones_changed(self):
+		self.watch_zone_index = None
+
+	def build_watch_zone_index(self):
+		""" Put every gadget's watch zones into the grid cells they overlap """
+		index = {}
+		outside = []
+		for gadget in self.contents or ():
+			if gadget.entity_type != entity_type['gadget'] or not hasattr(gadget, 'map_watch_zones') or not gadget.map_watch_zones:
+				continue
+			for zone_index, zone in enumerate(gadget.map_watch_zones):
+				entry = (gadget, zone_index, zone)
+				if zone[0] < 0 or zone[1] < 0 or zone[0]+zone[2] > self.width or zone[1]+zone[3] > self.height:
+					outside.append(entry)
+				x1, y1 = max(0, zone[0]), max(0, zone[1])
+				x2, y2 = min(self.width, zone[0]+zone[2])-1, min(self.height, zone[1]+zone[3])-1
+				if x2 < x1 or y2 < y1:
+					continue
+				for cell_y in range(y1 // watch_zone_cell_size, y2 // watch_zone_cell_size + 1):
+					for cell_x in range(x1 // watch_zone_cell_size, x2 // watch_zone_cell_size + 1):
+						index.setdefault((cell_x, cell_y), []).append(entry)
+		self.watch_zone_index = index
+		self.watch_zones_outside = outside
+
+	def watch_zones_near(self, fx, fy, tx, ty):
+		if self.watch_zone_index == None:
+			self.build_watch_zone_index()
+		entries = {}
+		for x, y in ((fx, fy), (tx, ty)):
+			if x < 0 or y < 0 or x >= self.width or y >= self.height:
+				candidates = self.watch_zones_outside
+			else:
+				candidates = self.watch_zone_index.get((x // watch_zone_cell_size, y // watch_zone_cell_size), ())
+			for entry in candidates:
+				entries[id(entry)] = entry
+		return list(entries.values())
+
+	def who_contents(self, viewer=None):
+		""" WHO message data; with an area of interest the viewer starts out only knowing about itself, and moved_in_contents() fills in the rest """
+		if viewer == None or not viewer.is_client() or not self.uses_area_of_interest():
+			return super().who_contents()
+		# The list replaces whatever the client knew about before, so forget that on both sides
+		for e in self.aoi_seen.get(viewer, ()):
+			self.aoi_seen_by.get(e, set()).discard(viewer)
+		self.aoi_seen[viewer] = set()
+		return {str(viewer.protocol_id()): viewer.who()}
+
+	# Area of interest
+
+	def uses_area_of_interest(self):
+		""" True if clients on this map only get told about entities near them; the index is started when the map loads or the flag gets turned on """
+		return self.aoi_grid != None
+
+	def start_area_of_interest(self):
+		""" Set up the spatial index, assuming every client currently knows about everything on the map """
+		self.aoi_grid = {}
+		self.aoi_cell = {}
+		self.aoi_seen = {}
+		self.aoi_seen_by = {}
+		contents = self.contents or set()
+		for viewer in contents:
+			if viewer.is_client():
+				for e in contents:
+					if e is not viewer:
+						self.aoi_seen.setdefault(viewer, set()).add(e)
+						self.aoi_seen_by.setdefault(e, set()).add(viewer)
+		for e in contents:
+			self.moved_in_contents(e)
+
+	def stop_area_of_interest(self, resend_who=False):
+		""" Go back to telling every client about everything on the map """
+		self.aoi_grid = None
+		self.aoi_cell = {}
+		self.aoi_seen = {}
+		self.aoi_seen_by = {}
+		if resend_who:
+			who_list = self.who_contents()
+			for e in self.contents or ():
+				if e.is_client():
+					e.send("WHO", {'list': who_list, 'you': e.protocol_id()})
+
+	def area_of_interest_filter(self, command_type, command_params, only_send_if=None):
+		""" Wrap only_send_if so that messages about an entity only go to clients that know about it """
+		if not self.uses_area_of_interest() or not isinstance(command_params, dict):
+			return only_send_if
+		if command_type == "MOV":
+			subject_id = command_params.get('id')
+		elif command_type == "WHO":
+			for key in ('add', 'update', 'remove', 'patch_mini_tilemap'):
+				if key in command_params:
+					subject_id = command_params[key]
+					if isinstance(subject_id, dict):
+						subject_id = subject_id.get('id')
+					break
+			else:
+				return only_send_if
+		else:
+			return only_send_if
+		subject = get_entity_by_id(subject_id, load_from_db=False) if subject_id != None else None
+		if subject == None:
+			return only_send_if
+		viewers = self.aoi_seen_by.get(subject, ())
+		def can_see(recipient):
+			if only_send_if and not only_send_if(recipient):
+				return False
+			return recipient is subject or recipient in viewers or not recipient.is_client() or recipient.map is not self
+		return can_see
+
+	def aoi_show(self, viewer, e):
+		self.aoi_seen.setdefault(viewer, set()).add(e)
+		self.aoi_seen_by.setdefault(e, set()).add(viewer)
+		viewer.send("WHO", {'add': e.who()})
+
+	def aoi_hide(self, viewer, e):
+		self.aoi_seen.get(viewer, set()).discard(e)
+		self.aoi_seen_by.get(e, set()).discard(viewer)
+		viewer.send("WHO", {'remove': e.protocol_id()})
+
+	def moved_in_contents(self, item):
+		""" Update the spatial index, and tell clients about anything that came into or went out of their view """
+		if not self.uses_area_of_interest() or item not in (self.contents or ()):
+			return
+		radius = max(1, Config["Server"]["AreaOfInterestRadius"]) # Also the grid cell size, so it can't be zero
+		cell = (item.x // radius, item.y // radius)
+		old_cell = self.aoi_cell.get(item)
+		if old_cell != cell:
+			if old_cell != None:
+				self.aoi_grid[old_cell].discard(item)
+				if not self.aoi_grid[old_cell]:
+					del self.aoi_grid[old_cell]
+			self.aoi_grid.setdefault(cell, set()).add(item)
+			self.aoi_cell[item] = cell
+
+		# Find everything in view of the item; being in view goes both ways
+		nearby = set()
+		for cell_y in range(cell[1]-1, cell[1]+2):
+			for cell_x in range(cell[0]-1, cell[0]+2):
+				for e in self.aoi_grid.get((cell_x, cell_y), ()):
+					if e is not item and abs(e.x - item.x) <= radius and abs(e.y - item.y) <= radius:
+						nearby.add(e)
+
+		# Update the clients who can see the item
+		viewers = set(e for e in nearby if e.is_client())
+		old_viewers = self.aoi_seen_by.get(item, set())
+		for viewer in viewers - old_viewers:
+			self.aoi_show(viewer, item)
+		for viewer in old_viewers - viewers:
+			self.aoi_hide(viewer, item)
+
+		# Update what the item can see, if it's a client
+		if item.is_client():
+			seen = self.aoi_seen.get(item, set())
+			item.start_batch()
+			for e in nearby - seen:
+				self.aoi_show(item, e)
+			for e in seen - nearby:
+				self.aoi_hide(item, e)
+			item.finish_batch()
+
+	def aoi_forget(self, item):
+		""" Remove an item from the spatial index after it leaves the map """
+		cell = self.aoi_cell.pop(item, None)
+		if cell != None and cell in self.aoi_grid:
+			self.aoi_grid[cell].discard(item)
+			if not self.aoi_grid[cell]:
+				del self.aoi_grid[cell]
+		for viewer in self.aoi_seen_by.pop(item, ()):
+			self.aoi_seen.get(viewer, set()).discard(item)
+		for e in self.aoi_seen.pop(item, ()):
+			self.aoi_seen_by.get(e, set()).discard(item)
 
 	def send_map_info(self, item, mai_only=False):
 		if not hasattr(item, 'connection'): # Map info should only get sent to clients, but it doesn't hurt to be sure
@@ -131,14 +475,16 @@ class Map(Entity):
 			self.load_data()
 
 		# Always send MAI for the map you move to, because it's the formal signal that you entered a new map
-		connection.send("MAI", self.map_info(user=item))
+		# Skip the map data if the client should already have it
+		if mai_only or self.protocol_id() in connection.loaded_maps:
+			connection.send("MAI", self.map_info(user=item))
+		else:
+			self.send_map_data(connection, self.map_info(user=item))
 		if mai_only:
 			return
-		# Skip the map data if the client should already have it
-		if self.protocol_id() not in connection.loaded_maps:
-			connection.send("MAP", self.map_section(0, 0, self.width-1, self.height-1))
 
 		if connection.see_past_map_edge and self.edge_id_links:
+			load_later = []
 			for linked_map_id in self.edge_id_links:
 				if linked_map_id == None:
 					continue
@@ -149,25 +495,120 @@ class Map(Entity):
 				linked_map = get_entity_by_id(linked_map_id, load_from_db=False)
 				if linked_map and linked_map.map_data_loaded:
 					mai = linked_map.map_info(user=item)
-					map = linked_map.map_section(0, 0, linked_map.width-1, linked_map.height-1)
 					mai['remote_map'] = linked_map_id
-					map['remote_map'] = linked_map_id
-					connection.send("MAI", mai)
-					connection.send("MAP", map)
+					linked_map.send_map_data(connection, mai, remote_map=linked_map_id)
 				else:
-					mai_map = temporarily_load_map_from_db(linked_map_id, user=item)
-					if mai_map == None:
-						continue
-					mai, map = mai_map
-					mai['remote_map'] = linked_map_id
-					map['remote_map'] = linked_map_id
-					connection.send("MAI", mai)
-					connection.send("MAP", map)
+					snapshot = NeighborMapCache.get(linked_map_id)
+					if snapshot != None:
+						send_map_snapshot(connection, linked_map_id, snapshot)
+					else:
+						load_later.append(linked_map_id)
 
 			connection.loaded_maps = set([x for x in self.edge_id_links if x != None] + [self.protocol_id()])
+			if load_later:
+				asyncio.get_event_loop().create_task(send_neighbor_maps_later(connection, load_later))
 		if connection.see_past_map_edge and not self.edge_id_links:
 			connection.loaded_maps = set([self.protocol_id()])
 
+	def send_map_data(self, connection, mai, remote_map=None):
+		""" Send MAI and then the whole map, or only what changed since the version the client has if it uses map_cache """
+		if not connection.caches_maps:
+			connection.send("MAI", mai)
+			connection.send_string(self.map_data_message(remote_map=remote_map) if remote_map != None else self.map_data_message())
+			return
+		map_id = str(self.protocol_id())
+		version = self.observe_content_version()
+		changed = self.content_changes_since(connection.cached_map_versions.get(map_id))
+		connection.cached_map_versions[map_id] = version
+		mai['content_version'] = version
+
+		if changed == None:
+			mai['map_cache'] = 'full'
+			connection.send("MAI", mai)
+			if remote_map != None:
+				connection.send_string(self.map_data_message(remote_map=remote_map, content_version=version))
+			else:
+				connection.send_string(self.map_data_message(content_version=version))
+		elif not changed:
+			mai['map_cache'] = 'unchanged'
+			connection.send("MAI", mai)
+		else:
+			mai['map_cache'] = 'changed'
+			connection.send("MAI", mai)
+			rectangles = map_chunk_rectangles(self.width, self.height)
+			for chunk_index in sorted(changed):
+				x1, y1, x2, y2 = rectangles[chunk_index]
+				section = self.map_section(x1, y1, x2, y2, remote_map=remote_map)
+				section['content_version'] = version
+				connection.send("MAP", section)
+
+	def observe_content_version(self):
+		""" Get the content version to give to a client, making a new one if the map changed since the last one was given out """
+		if self.content_changes == None or self.content_changes:
+			# Based on the time so that versions given out before a restart, but never saved, don't get reused
+			version = max(self.content_version + 1, int(time.time() * 1000))
+			if self.content_changes == None:
+				self.content_history = []
+				self.content_history_base = version
+			else:
+				self.content_history.append((version, self.content_changes))
+				if len(self.content_history) > map_content_history_length:
+					self.content_history_base = self.content_history.pop(0)[0]
+			self.content_version = version
+			self.content_changes = set()
+		return self.content_version
+
+	def content_changes_since(self, version):
+		""" Chunks that changed after a content version; an empty set if nothing did, or None if the whole map should be sent """
+		if version == None:
+			return None
+		if version == self.content_version:
+			return set()
+		if version != self.content_history_base and all(v != version for v, _ in self.content_history):
+			return None
+		changed = set()
+		for v, chunks in self.content_history:
+			if v > version:
+				changed |= chunks
+		if len(changed) * 2 > len(map_chunk_rectangles(self.width, self.height)):
+			return None
+		return changed
+
+	def map_content_changed(self, chunk_indexes):
+		""" Note that some chunks changed, so they get saved and map_cache clients get them """
+		self.dirty_map_chunks.update(chunk_indexes)
+		if self.content_changes != None:
+			self.content_changes.update(chunk_indexes)
+		if self.map_data_json_cache != None:
+			self.forget_map_data_json()
+
+	def map_data_json(self):
+		""" JSON text for map_section() of the whole map; only made once until the map changes """
+		cache = self.map_data_json_cache
+		if cache == None or cache[0] != self.default_turf:
+			cache = (self.default_turf, json.dumps(self.map_section(0, 0, self.width-1, self.height-1), separators=(',', ':')))
+			self.map_data_json_cache = cache
+			self.map_data_gzip_cache = None
+		return cache[1]
+
+	def map_data_message(self, **extra_fields):
+		""" Protocol message string for MAP with the whole map, with some extra fields added on to the cached JSON """
+		text = self.map_data_json()
+		if not extra_fields:
+			return "MAP " + text
+		return "MAP " + text[:-1] + "," + json.dumps(extra_fields, separators=(',', ':'))[1:]
+
+	def map_data_gzip(self):
+		""" gzip compressed {"data": map data}, for the API """
+		text = self.map_data_json()
+		if self.map_data_gzip_cache == None:
+			self.map_data_gzip_cache = gzip.compress(('{"data":' + text + '}').encode())
+		return self.map_data_gzip_cache
+
+	def forget_map_data_json(self):
+		self.map_data_json_cache = None
+		self.map_data_gzip_cache = None
+
 	def resend_map_info_to_users(self, mai_only=False):
 		if not self.contents:
 			return
@@ -184,12 +625,20 @@ class Map(Entity):
 
 	def remove_from_contents(self, item, new_map_id=None, new_map_name=None):
 		super().remove_from_contents(item, new_map_id, new_map_name)
+		if self.aoi_grid != None:
+			self.aoi_forget(item)
+		if getattr(item, 'map_watch_zones', None):
+			self.watch_zones_changed()
 		if item.is_client():
 			self.user_count -= 1
 			if self.user_count == 0 and self.map_data_loaded:
-				# Save if the map was modified
-				self.save_data()
-				self.unload_data()
+				if Config["Server"]["WarmMapCells"] > 0 and self.db_id != None and not self.temporary:
+					# Saving and unloading happens if it gets evicted
+					keep_map_warm(self)
+				else:
+					# Save if the map was modified
+					self.save_data()
+					self.unload_data()
 			if self.user_count == 0:
 				self.topic = None
 				self.topic_username = None
@@ -200,11 +649,89 @@ class Map(Entity):
 		self.height = height
 
 		# construct the map
-		self.turfs = []
-		self.objs = []
-		for x in range(0, width):
-			self.turfs.append([None] * height)
-			self.objs.append([None] * height)
+		self.turfs = TileGrid(width, height)
+		self.objs = TileGrid(width, height)
+		self.density = None
+		self.content_changes = None
+		self.forget_map_data_json()
+		self.dirty_map_chunks = set()
+		self.map_chunks_in_db = False
+
+	def set_default_turf(self, turf):
+		""" Change the turf used for empty tiles; that changes every empty tile, so map_cache clients need the whole map again """
+		if turf == self.default_turf:
+			return
+		self.default_turf = turf
+		self.content_changes = None
+		self.forget_map_data_json()
+		if self.map_data_loaded:
+			self.map_data_modified = True # So the new content version gets saved along with the new default turf
+
+	def resize_map(self, width, height):
+		""" Change the map's size, keeping whatever is in the top left """
+		self.turfs.resize(width, height)
+		self.objs.resize(width, height)
+		self.width = width
+		self.height = height
+		self.density = None
+		self.content_changes = None # Chunk numbering changed too, so clients need the whole map
+		self.forget_map_data_json()
+		self.map_chunks_in_db = False # Chunk numbering depends on the size, so everything has to be written again
+		self.watch_zones_changed()
+
+	def get_turf(self, x, y):
+		return self.turfs.get(x, y)
+
+	def get_objs(self, x, y):
+		return self.objs.get(x, y)
+
+	def put_turf(self, x, y, turf):
+		self.turfs.set(x, y, turf)
+		self.map_content_changed((map_chunk_index(x, y, self.height),))
+		if self.density != None:
+			self.update_density(x, y, x, y)
+
+	def put_objs(self, x, y, objs):
+		self.objs.set(x, y, objs)
+		self.map_content_changed((map_chunk_index(x, y, self.height),))
+		if self.density != None:
+			self.update_density(x, y, x, y)
+
+	def fill_section(self, x1, y1, x2, y2, turf=False, objs=False):
+		""" Set a rectangle (inclusive) to one turf and/or one obj list; False leaves that layer alone """
+		if turf is not False:
+			self.turfs.fill(x1, y1, x2, y2, turf)
+		if objs is not False:
+			self.objs.fill(x1, y1, x2, y2, objs)
+		if x2 >= x1 and y2 >= y1:
+			self.map_content_changed(map_chunk_indexes_in(x1, y1, x2, y2, self.height))
+			if self.density != None:
+				self.update_density(x1, y1, x2, y2)
+
+	def is_dense(self, x, y):
+		""" True if the turf or any of the objs at a position on the map are dense """
+		return self.get_density()[x * self.height + y] == 1
+
+	def get_density(self):
+		""" Get the density bytearray, building it if it's missing or the tile definitions changed since it was built """
+		if self.density == None or self.density_version != TileTableVersion[0]:
+			self.build_density()
+		return self.density
+
+	def build_density(self):
+		# Work out the density of each palette entry, instead of each cell
+		turf_dense = [bool(get_tile_density(turf)) for turf in self.turfs.palette]
+		objs_dense = [get_objs_density(objs) for objs in self.objs.palette]
+		self.density = bytearray(1 if (turf_dense[turf] or objs_dense[objs]) else 0 for turf, objs in zip(self.turfs.cells, self.objs.cells))
+		self.density_version = TileTableVersion[0]
+
+	def update_density(self, x1, y1, x2, y2):
+		""" Recalculate the density of a rectangle (inclusive) after it's changed """
+		density = self.density
+		height = self.height
+		for x in range(x1, x2+1):
+			for y in range(y1, y2+1):
+				density[x * height + y] = 1 if (get_tile_density(self.turfs.get(x, y)) or get_objs_density(self.objs.get(x, y))) else 0
 
 	def load(self, map_id):
 		""" Load a map from a file """
@@ -215,6 +742,8 @@ class Map(Entity):
 			return False
 
 		self.map_flags = result[0]
+		if self.map_flags & mapflag['nearby_only']:
+			self.start_area_of_interest() # Before the contents get loaded, so they get added to the index
 		self.start_pos = [result[1], result[2]]
 		self.width = result[3]  # Will be overwritten by the blank_map call but that's ok
 		self.height = result[4]
@@ -233,29 +762,48 @@ class Map(Entity):
 		if self.map_data_loaded:
 			self.turfs = None
 			self.objs = None
+			self.density = None
+			self.forget_map_data_json()
 			self.map_data_loaded = False
 
 	def load_data(self, load_anyway=False):
 		if self.map_data_loaded:
 			return True
 		if self.user_count or load_anyway:
-			d = loads_if_not_none(self.load_data_as_text())
+			d = load_map_data_from_db(self.db_id) if self.db_id != None else None
+			MapLoadStats["cold_loads"] += 1
 
 			# Parse map data
-			if d:
+			if isinstance(d, MapBlob):
+				self.blank_map(d.width, d.height)
+				d.load_into(self.turfs, self.objs)
+				self.map_chunks_in_db = d.uses_chunk_table
+				if not d.uses_chunk_table:
+					self.map_data_modified = True # Move the chunks into Map_Chunk next time it's saved
+				extra = d.extra
+			elif d:
+				# Older JSON format; it'll get rewritten in the binary format the next time the map is saved
 				self.blank_map(d["pos"][2]+1, d["pos"][3]+1) # pos is [firstX, firstY, lastX, lastY]
 				for t in d["turf"]:
-					self.turfs[t[0]][t[1]] = t[2]
+					self.put_turf(t[0], t[1], t[2])
 				for o in d["obj"]:
-					self.objs[o[0]][o[1]] = o[2]
-				if "edge_links" in d:
-					self.edge_id_links = d["edge_links"]
-				if "wallpaper" in d:
-					self.map_wallpaper = d["wallpaper"]
-				if "music" in d:
-					self.map_music = d["music"]
+					self.put_objs(o[0], o[1], o[2])
+				self.map_data_modified = True
+				extra = d
 			else:
 				self.blank_map(self.width, self.height)
+				extra = {}
+
+			if "edge_links" in extra:
+				self.edge_id_links = extra["edge_links"]
+			if "wallpaper" in extra:
+				self.map_wallpaper = extra["wallpaper"]
+			if "music" in extra:
+				self.map_music = extra["music"]
+			self.content_version = extra.get("content_version", 0)
+			self.content_changes = set() if self.content_version else None
+			self.content_history = []
+			self.content_history_base = self.content_version
 			self.map_data_loaded = True
 		return True
 
@@ -264,6 +812,7 @@ class Map(Entity):
 		super().save()
 		if self.db_id == None or self.temporary:
 			return
+		forget_neighbor_map(self.db_id)
 
 		# Create new map if map doesn't already exist
 		c = Database.cursor()
@@ -281,16 +830,43 @@ class Map(Entity):
 
 	def save_data(self):
 		if self.map_data_modified and self.map_data_loaded:
-			data = self.map_section(0, 0, self.width-1, self.height-1)
+			extra = {}
 			if self.edge_id_links != None:
-				data["edge_links"] = self.edge_id_links
+				extra["edge_links"] = self.edge_id_links
 			if self.map_wallpaper != None:
-				data["wallpaper"] = self.map_wallpaper
+				extra["wallpaper"] = self.map_wallpaper
 			if self.map_music != None:
-				data["music"] = self.map_music
-			self.save_data_as_text(json.dumps(data))
+				extra["music"] = self.map_music
+			extra["content_version"] = self.observe_content_version()
+			forget_neighbor_map(self.db_id)
+			self.save_data_as_blob(encode_map_blob(self.turfs, self.objs, extra, chunk_table=True))
+			self.save_map_chunks()
 			self.map_data_modified = False
 
+	def save_data_as_blob(self, blob):
+		""" Save binary map data to the database """
+		c = Database.cursor()
+		c.execute("UPDATE Entity SET data=?, compressed_data=? WHERE id=?", (map_blob_data_marker, blob, self.db_id,))
+
+	def save_map_chunks(self):
+		""" Write the chunks that changed since the last save to Map_Chunk, or all of them if the table isn't up to date """
+		c = Database.cursor()
+		rectangles = map_chunk_rectangles(self.width, self.height)
+		if self.map_chunks_in_db:
+			write_chunks = [i for i in self.dirty_map_chunks if i < len(rectangles)]
+		else:
+			c.execute('DELETE FROM Map_Chunk WHERE map_id=?', (self.db_id,))
+			write_chunks = range(len(rectangles))
+
+		for i in write_chunks:
+			chunk = encode_map_chunk(self.turfs, self.objs, rectangles[i])
+			if chunk:
+				c.execute("INSERT OR REPLACE INTO Map_Chunk (map_id, chunk_index, data) VALUES (?, ?, ?)", (self.db_id, i, chunk))
+			elif self.map_chunks_in_db:
+				c.execute('DELETE FROM Map_Chunk WHERE map_id=? AND chunk_index=?', (self.db_id, i))
+		self.dirty_map_chunks.clear()
+		self.map_chunks_in_db = True
+
 	def apply_map_section(self, data, broadcast=True):
 		x1, y1, x2, y2 = data['pos']
 
@@ -299,37 +875,30 @@ class Map(Entity):
 			erase_with = data['default']
 
 		# Delete the section first
-		for x in range(x1, x2+1):
-			for y in range(y1, y2+1):
-				self.turfs[x][y] = erase_with
-				self.objs[x][y] = None
+		self.fill_section(x1, y1, x2, y2, turf=erase_with, objs=None)
 
 		for t in data["turf"]:
-			self.turfs[t[0]][t[1]] = t[2]
+			self.put_turf(t[0], t[1], t[2])
 		for o in data["obj"]:
-			self.objs[o[0]][o[1]] = o[2]
+			self.put_objs(o[0], o[1], o[2])
 
 		if broadcast:
 			self.broadcast("MAP", data, send_to_links=True)
 		self.map_data_modified = True
 
-	def map_section(self, x1, y1, x2, y2):
+	def map_section(self, x1, y1, x2, y2, remote_map=None):
 		""" Returns a section of map as a list of turfs and objects """
 		# clamp down the numbers
-		x1 = min(self.width, max(0, x1))
-		y1 = min(self.height, max(0, y1))
-		x2 = min(self.width, max(0, x2))
-		y2 = min(self.height, max(0, y2))
+		x1 = min(self.width-1, max(0, x1))
+		y1 = min(self.height-1, max(0, y1))
+		x2 = min(self.width-1, max(0, x2))
+		y2 = min(self.height-1, max(0, y2))
 
 		# scan the map
-		turfs = []
-		objs  = []
-		for x in range(x1, x2+1):
-			for y in range(y1, y2+1):
-				if self.turfs[x][y] != None:
-					turfs.append([x, y, self.turfs[x][y]])
-				if self.objs[x][y] != None:
-					objs.append([x, y, self.objs[x][y]])
+		turfs = list(self.turfs.items_in(x1, y1, x2, y2))
+		objs  = list(self.objs.items_in(x1, y1, x2, y2))
+		if remote_map != None:
+			return {'pos': [x1, y1, x2, y2], 'default': self.default_turf, 'turf': turfs, 'obj': objs, 'remote_map': remote_map}
 		return {'pos': [x1, y1, x2, y2], 'default': self.default_turf, 'turf': turfs, 'obj': objs}
 
 	def map_info(self, user=None, all_info=False):
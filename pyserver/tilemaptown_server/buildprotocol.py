@@ -560,6 +560,15 @@ def fn_BAG(connection, map, client, arg, context):
 		# Delete from the database too
 		if delete_me.db_id:
 			c.execute('DELETE FROM Entity WHERE owner_id=? AND id=?', (client.db_id, delete_me.db_id))
+			EntityPermissionCache.discard(delete_me.db_id)
+			EntityNameAndType.discard(delete_me.db_id)
+			forget_cached_permissions(subject_id=delete_me.db_id)
+			if delete_me.is_map():
+				if c.rowcount:
+					# Foreign keys aren't turned on, so the cascade in the schema doesn't do this
+					c.execute('DELETE FROM Map_Chunk WHERE map_id=?', (delete_me.db_id,))
+				forget_neighbor_map(delete_me.db_id)
+				forget_warm_map(delete_me.db_id)
 		if delete_me.map and delete_me.map != client:
 			client.send("BAG", {'remove': {'id': delete['id']}})
 		if delete_me.map:
@@ -753,6 +762,9 @@ def fn_MAP(connection, map, client, arg, context):
 
 @protocol_command(map_only=True)
 def fn_MAI(connection, map, client, arg, context):
+	if "map_cache" in arg:
+		update_cached_map_versions(connection, arg["map_cache"])
+		return
 	send_all_info = must_be_map_owner(connection, client, context, True, give_error=False)
 	map_info = map.map_info(all_info=send_all_info)
 	if "remote_map" in arg:
@@ -813,12 +825,7 @@ def fn_DEL(connection, map, client, arg, context):
 		connection.build_session.write_del(map.protocol_id(), x1, y1, x2, y2, old_data, turf_replace, objs_replace)
 
 		# Do the delete and tell clients about it
-		for x in range(x1, x2+1):
-			for y in range(y1, y2+1):
-				if arg["turf"]:
-					map.turfs[x][y] = turf_replace;
-				if arg["obj"]:
-					map.objs[x][y] = objs_replace;
+		map.fill_section(x1, y1, x2, y2, turf=turf_replace if arg["turf"] else False, objs=objs_replace if arg["obj"] else False)
 		# make username available to listeners
 		arg['username'] = client.username_or_id()
 		arg['id'] = client.protocol_id()
@@ -859,9 +866,10 @@ def fn_PUT(connection, map, client, arg, context):
 		if arg.get("obj", False): #object
 			tile_test = [tile_is_okay(x) for x in arg["atom"]]
 			if all(_[0] for _ in tile_test): # all tiles pass the test
-				write_to_build_log(map, client, "PUT", arg, map.objs[x][y])
-				connection.build_session.write_put_objs(map.protocol_id(), x, y, arg["atom"], map.objs[x][y])
-				map.objs[x][y] = arg["atom"]
+				old_objs = map.get_objs(x, y)
+				write_to_build_log(map, client, "PUT", arg, old_objs)
+				connection.build_session.write_put_objs(map.protocol_id(), x, y, arg["atom"], old_objs)
+				map.put_objs(x, y, arg["atom"])
 				notify_listeners()
 				map.broadcast("MAP", map.map_section(x, y, x, y), send_to_links=True)
 			else:
@@ -872,10 +880,11 @@ def fn_PUT(connection, map, client, arg, context):
 			tile_test = tile_is_okay(arg["atom"])
 			if tile_test[0]:
 				written_turf = arg["atom"] if arg["atom"] != map.default_turf else None
-				if map.turfs[x][y] != written_turf:
-					write_to_build_log(map, client, "PUT", arg, map.turfs[x][y])
-					connection.build_session.write_put_turf(map.protocol_id(), x, y, arg["atom"], map.turfs[x][y])
-					map.turfs[x][y] = written_turf
+				old_turf = map.get_turf(x, y)
+				if old_turf != written_turf:
+					write_to_build_log(map, client, "PUT", arg, old_turf)
+					connection.build_session.write_put_turf(map.protocol_id(), x, y, arg["atom"], old_turf)
+					map.put_turf(x, y, written_turf)
 					notify_listeners()
 					map.broadcast("MAP", map.map_section(x, y, x, y), send_to_links=True)
 				else:
@@ -927,24 +936,24 @@ def fn_BLK(connection, map, client, arg, context):
 				for w in range(width):
 					row = []
 					for h in range(height):
-						row.append(map.turfs[x1+w][y1+h])
+						row.append(map.get_turf(x1+w, y1+h))
 					copied.append(row)
 
 				for w in range(width):
 					for h in range(height):
-						map.turfs[x2+w][y2+h] = copied[w][h]
+						map.put_turf(x2+w, y2+h, copied[w][h])
 			# obj
 			if do_obj:
 				copied = []
 				for w in range(width):
 					row = []
 					for h in range(height):
-						row.append(map.objs[x1+w][y1+h])
+						row.append(map.get_objs(x1+w, y1+h))
 					copied.append(row)
 
 				for w in range(width):
 					for h in range(height):
-						map.objs[x2+w][y2+h] = copied[w][h]
+						map.put_objs(x2+w, y2+h, copied[w][h])
 
 		# place the tiles
 		for turf in arg.get("turf", []):
@@ -956,9 +965,7 @@ def fn_BLK(connection, map, client, arg, context):
 			if len(turf) == 5:
 				width = turf[3]
 				height = turf[4]
-			for w in range(width):
-				for h in range(height):
-					map.turfs[x+w][y+h] = a
+			map.fill_section(x, y, x+width-1, y+height-1, turf=a)
 		# place the object lists
 		for obj in arg.get("obj", []):
 			x = obj[0]
@@ -969,9 +976,7 @@ def fn_BLK(connection, map, client, arg, context):
 			if len(turf) == 5:
 				width = turf[3]
 				height = turf[4]
-			for w in range(width):
-				for h in range(height):
-					map.objs[x+w][y+h] = a
+			map.fill_section(x, y, x+width-1, y+height-1, objs=a)
 		map.broadcast("BLK", arg, remote_category=maplisten_type['build'])
 	else:
 		connection.protocol_error(context, text='Bulk building is disabled on this map', code='missing_permission', detail='bulk_build', subject_id=map)
@@ -1061,7 +1066,7 @@ def fn_WHO(connection, map, client, arg, context):
 
 @protocol_command(pre_identify=True)
 def fn_PIN(connection, map, client, arg, context):
-	connection.ping_timer = 300
+	connection.reset_ping_timer(300)
 
 @protocol_command(pre_identify=True)
 def fn_ACK(connection, map, client, arg, context):
@@ -1096,8 +1101,22 @@ server_feature_attribute = {
 	"entity_message_forwarding": "can_forward_messages_to",
 	"user_watch_with_who": "user_watch_with_who",
 	"message_acknowledgement": "can_acknowledge",
+	"map_cache": "caches_maps",
 }
 
+map_cache_report_limit = 1000
+
+def update_cached_map_versions(connection, versions):
+	""" Take a {map ID: content version} dictionary from a map_cache client; null versions mean the client doesn't have that map anymore """
+	if not connection.caches_maps or not isinstance(versions, dict):
+		return
+	for map_id, version in versions.items():
+		if isinstance(version, int) and not isinstance(version, bool):
+			if len(connection.cached_map_versions) < map_cache_report_limit or str(map_id) in connection.cached_map_versions:
+				connection.cached_map_versions[str(map_id)] = version
+		else:
+			connection.cached_map_versions.pop(str(map_id), None)
+
 @protocol_command(pre_identify=True)
 def fn_IDN(connection, map, client, arg, context):
 	if connection.identified: # Already identified
@@ -1202,6 +1221,8 @@ def fn_IDN(connection, map, client, arg, context):
 				# Add it to the set and acknowledge it too
 				connection.features.add(key)
 				ack_info["features"][key] = {"version": available_server_features[key]["version"]}
+	if "map_cache" in arg:
+		update_cached_map_versions(connection, arg["map_cache"])
 	
 	# Pick a secure API key, if the API is enabled
 	if Config["API"]["Enabled"]:
@@ -14,7 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import asyncio, json, traceback
+import asyncio, json, traceback, struct, array
 from .buildglobal import *
 from enum import IntEnum
 from .buildcommand import handle_user_command, send_private_message, send_message_to_map, apply_rate_limiting
@@ -38,6 +38,7 @@ class VM_MessageType(IntEnum):
 	SCRIPT_ERROR = 11
 	STATUS_QUERY = 12
 	SCRIPT_PRINT = 13
+	API_CALL_MULTI = 14
 
 class ScriptingValueType(IntEnum):
 	NIL = 0
@@ -129,7 +130,7 @@ def fn_runitem(e, arg):
 		return False
 	text = text_from_text_item(arg[0])
 	if text:
-		send_scripting_message(VM_MessageType.RUN_CODE, user_id=e.owner_id, entity_id=e.db_id if e.db_id else -e.id, data=text.encode())
+		send_scripting_message(VM_MessageType.RUN_CODE, user_id=e.owner_id, entity_id=e.db_id if e.db_id else -e.id, data=text.encode(), vm=scripting_vm_for_entity(e))
 		return True
 	return False
 
@@ -141,7 +142,7 @@ def fn_callitem(e, arg):
 		return None
 	text = text_from_text_item(arg[0])
 	if text:
-		send_scripting_message(VM_MessageType.RUN_CODE, user_id=e.owner_id, entity_id=e.db_id if e.db_id else -e.id, other_id=arg[1], status=1, data=text.encode())
+		send_scripting_message(VM_MessageType.RUN_CODE, user_id=e.owner_id, entity_id=e.db_id if e.db_id else -e.id, other_id=arg[1], status=1, data=text.encode(), vm=scripting_vm_for_entity(e))
 		# Hack to prevent returning a response
 		return do_not_return_response
 	else:
@@ -175,7 +176,7 @@ def fn_m_turf(e, arg): #ii
 		x = arg[0]
 		y = arg[1]
 		if x >= 0 and y >= 0 and x < e.map.width and y < e.map.height:
-			return [e.map.turfs[x][y] or e.map.default_turf]
+			return [e.map.get_turf(x, y) or e.map.default_turf]
 	else:
 		return None
 
@@ -185,7 +186,7 @@ def fn_m_objs(e, arg): #ii
 		x = arg[0]
 		y = arg[1]
 		if x >= 0 and y >= 0 and x < e.map.width and y < e.map.height:
-			return [e.map.objs[x][y] or []]
+			return [e.map.get_objs(x, y) or []]
 	else:
 		return None
 
@@ -195,12 +196,62 @@ def fn_m_dense(e, arg): #iii
 		x = arg[0]
 		y = arg[1]
 		if x >= 0 and y >= 0 and x < e.map.width and y < e.map.height:
-			return get_tile_density(e.map.turfs[x][y]) or any((get_tile_density(o) for o in (e.map.objs[x][y] or [])))
+			return e.map.is_dense(x, y)
 		else:
 			return True
 	else:
 		return None
 
+script_region_max_cells = 4096
+
+@script_api()
+def fn_m_region(e, arg): #iiiis
+	""" Get a rectangle of turfs, objs or densities at once. The rectangle is clipped to the map, and the result says which part was used.
+	"turf" and "objs" give a palette and a list of palette indexes, row by row. "dense" gives a list of 32-bit masks for each row,
+	where bit n of a row's mask number m is set if the cell at x+m*32+n is dense. """
+	if e.map == None or not e.map.is_map() or not e.map.map_data_loaded:
+		return None
+	x1 = max(0, arg[0])
+	y1 = max(0, arg[1])
+	x2 = min(e.map.width-1,  arg[0]+arg[2]-1)
+	y2 = min(e.map.height-1, arg[1]+arg[3]-1)
+	if x2 < x1 or y2 < y1 or (x2-x1+1) * (y2-y1+1) > script_region_max_cells:
+		return None
+	result = {"x": x1, "y": y1, "width": x2-x1+1, "height": y2-y1+1}
+	what = arg[4] if len(arg) >= 5 else "turf"
+
+	if what == "turf" or what == "objs":
+		grid = e.map.turfs if what == "turf" else e.map.objs
+		empty = e.map.default_turf if what == "turf" else []
+		# Give indexes into a palette that only has the tiles in this rectangle
+		local_palette = [empty]
+		local_index = {0: 0}
+		cells = []
+		for row in grid.index_rows(x1, y1, x2, y2):
+			for index in row:
+				local = local_index.get(index)
+				if local == None:
+					local = len(local_palette)
+					local_index[index] = local
+					local_palette.append(grid.palette[index])
+				cells.append(local)
+		result["palette"] = local_palette
+		result["cells"] = cells
+		return result
+	elif what == "dense":
+		density = e.map.get_density()
+		height = e.map.height
+		masks = []
+		for y in range(y1, y2+1):
+			row_masks = [0] * ((x2-x1+32) // 32)
+			for i in range(x2-x1+1):
+				if density[(x1+i) * height + y]:
+					row_masks[i >> 5] |= 1 << (i & 31)
+			masks.append(row_masks)
+		result["dense"] = masks
+		return result
+	return None
+
 @script_api()
 def fn_m_tilelookup(e, arg): #s
 	return get_tile_properties(arg[0])
@@ -227,9 +278,7 @@ def fn_m_watchzones(e, arg): #iiii iiii iiii iiii iiii iiii iiii iiii iiii iiii
 	# Up to 10 rectangles
 	if (len(arg) % 4) != 0:
 		return
-	e.map_watch_zones = []
-	for i in range(len(arg)//4):
-		e.map_watch_zones.append(arg[i*4:i*4+4])
+	e.set_watch_zones([arg[i*4:i*4+4] for i in range(len(arg)//4)])
 
 @script_api()
 def fn_m_size(e, arg): #
@@ -428,7 +477,7 @@ def fn_e_step(e, arg): #Ei
 		new_y = from_y + directions[arg[1]][1]
 		if Config["RateLimit"]["ScriptMove"] and apply_rate_limiting(e2, 'sm', ( (1, 900), (2, 1800) )):
 			return
-		if e2.map and (not e2.map.is_map() or (new_x >= 0 and new_y >= 0 and new_x < e2.map.width and new_y < e2.map.height and (not get_tile_density(e2.map.turfs[new_x][new_y]) and not any((get_tile_density(o) for o in (e2.map.objs[new_x][new_y] or [])))))):
+		if e2.map and (not e2.map.is_map() or (new_x >= 0 and new_y >= 0 and new_x < e2.map.width and new_y < e2.map.height and not e2.map.is_dense(new_x, new_y))):
 			e2.move_to(new_x, new_y, new_dir=arg[1])
 			e2.map.broadcast("MOV", {'id': e2.protocol_id(), 'from': [from_x, from_y], 'to': [new_x, new_y], 'dir': e2.dir}, remote_category=maplisten_type['move'])
 
@@ -638,30 +687,69 @@ def fn_releasecontrols(e, arg): #EI
 
 # -----------------------------------------------------------------------------
 
+scripting_value_int = struct.Struct('<Bi')
+scripting_value_uint = struct.Struct('<BI')
+scripting_value_size = struct.Struct('<I')
+scripting_value_mini_tilemap = struct.Struct('<BBH')
+scripting_message_header = struct.Struct('<IiiiB')
+scripting_message_header_size = scripting_message_header.size
+mini_tilemap_array_type = 'I' if array.array('I').itemsize == 4 else 'L'
+
 def encode_scripting_message_values(values):
-	b = bytes()
+	# Measure first so the whole payload can be written into one buffer
+	encoded = []
+	total = 0
 	for x in values:
-		if x == None:
-			b += bytes([ScriptingValueType.NIL])
-		elif isinstance(x, bool) and x == True:
-			b += bytes([ScriptingValueType.TRUE])
-		elif isinstance(x, bool) and x == False:
-			b += bytes([ScriptingValueType.FALSE])
+		if x is None or isinstance(x, bool):
+			total += 1
+			encoded.append(None)
 		elif isinstance(x, int):
-			b += bytes([ScriptingValueType.INTEGER]) + x.to_bytes(4, byteorder='little')
-		elif isinstance(x, str):
-			d = x.encode()
-			b += bytes([ScriptingValueType.STRING]) + len(d).to_bytes(4, byteorder='little') + d
+			total += 5
+			encoded.append(None)
+		else:
+			d = x.encode() if isinstance(x, str) else json.dumps(x).encode()
+			total += 5 + len(d)
+			encoded.append(d)
+
+	b = bytearray(total)
+	i = 0
+	for x, d in zip(values, encoded):
+		if x is None:
+			b[i] = ScriptingValueType.NIL
+			i += 1
+		elif x is True:
+			b[i] = ScriptingValueType.TRUE
+			i += 1
+		elif x is False:
+			b[i] = ScriptingValueType.FALSE
+			i += 1
+		elif d is None:
+			(scripting_value_int if x < 0 else scripting_value_uint).pack_into(b, i, ScriptingValueType.INTEGER, x)
+			i += 5
 		else:
-			d = json.dumps(x).encode()
-			b += bytes([ScriptingValueType.JSON]) + len(d).to_bytes(4, byteorder='little') + d
+			size = len(d)
+			scripting_value_uint.pack_into(b, i, ScriptingValueType.STRING if isinstance(x, str) else ScriptingValueType.JSON, size)
+			i += 5
+			b[i:i+size] = d
+			i += size
 	return b
 
+def decode_mini_tilemap_words(data):
+	""" Converts a buffer of little endian uint32 values into a list """
+	words = array.array(mini_tilemap_array_type)
+	words.frombytes(data)
+	if sys.byteorder != 'little':
+		words.byteswap()
+	return words.tolist()
+
 def decode_scripting_message_values(b):
 	values = []
+	view = memoryview(b)
 	i = 0
-	while i < len(b):
-		t = b[i]
+	end = len(view)
+	unpack_size = scripting_value_size.unpack_from
+	while i < end:
+		t = view[i]
 		i += 1
 		if t == ScriptingValueType.NIL:
 			values.append(None)
@@ -670,49 +758,164 @@ def decode_scripting_message_values(b):
 		elif t == ScriptingValueType.TRUE:
 			values.append(True)
 		elif t == ScriptingValueType.INTEGER:
-			values.append(int.from_bytes(b[i:i+4], byteorder='little', signed=True))
+			values.append(scripting_value_int.unpack_from(view, i-1)[1])
 			i += 4
 		elif t == ScriptingValueType.STRING:
-			size = int.from_bytes(b[i:i+4], byteorder='little')
+			size = unpack_size(view, i)[0]
 			i += 4
-			values.append(b[i:i+size].decode())
+			values.append(str(view[i:i+size], 'utf-8'))
 			i += size
 		elif t == ScriptingValueType.JSON:
-			size = int.from_bytes(b[i:i+4], byteorder='little')
+			size = unpack_size(view, i)[0]
 			i += 4
-			values.append(json.loads(b[i:i+size]).decode())
+			values.append(json.loads(str(view[i:i+size], 'utf-8')))
 			i += size
 		elif t == ScriptingValueType.MINI_TILEMAP:
-			width  = b[i+0]
-			height = b[i+1]
-			i += 2
-			length = int.from_bytes(b[i:i+2], byteorder='little', signed=False)
-			i += 2
-			map = []
-			for j in range(length):
-				map.append(int.from_bytes(b[i:i+4], byteorder='little', signed=False))
-				i += 4
-			values.append((width, height, map))
+			width, height, length = scripting_value_mini_tilemap.unpack_from(view, i)
+			i += 4
+			values.append((width, height, decode_mini_tilemap_words(view[i:i+length*4])))
+			i += length*4
 		else:
 			print("Unknown scripting message value: %s" % t)
 			break
 	return values
 
 def create_scripting_message(type, user_id=0, entity_id=0, other_id=0, status=0, data=None):
-	return type.to_bytes(1, byteorder='little', signed=False) \
-	+ (len(data) if data else 0).to_bytes(3, byteorder='little', signed=False) \
-	+ user_id.to_bytes(4, byteorder='little', signed=True) \
-	+ entity_id.to_bytes(4, byteorder='little', signed=True) \
-	+ other_id.to_bytes(4, byteorder='little', signed=True) \
-	+ status.to_bytes(1, byteorder='little', signed=False) \
-	+ (data or bytes(0))
-
-def send_scripting_message(type, user_id=0, entity_id=0, other_id=0, status=0, data=None):
-	if scripting_service_proc == None:
+	size = len(data) if data else 0
+	message = bytearray(scripting_message_header_size + size)
+	scripting_message_header.pack_into(message, 0, type | (size << 8), user_id, entity_id, other_id, status)
+	if size:
+		message[scripting_message_header_size:] = data
+	return message
+
+# Scripts are spread across Config["Scripting"]["ProcessCount"] copies of the scripting service, picked by owner,
+# so that one user's runaway script only slows down the scripts that share a process with it
+scripting_vms = []
+scripting_write_batch_size = 0x10000
+
+def scripting_vm_for(user_id, entity_id):
+	return scripting_vms[(user_id or entity_id) % len(scripting_vms)]
+
+def scripting_vm_for_entity(e):
+	""" The VM an entity's script was started in; its owner can change while it's running, so it can't be picked again """
+	if e.script_vm == None:
+		e.script_vm = scripting_vm_for(e.owner_id, e.db_id if e.db_id else -e.id)
+	return e.script_vm
+
+def send_scripting_message(type, user_id=0, entity_id=0, other_id=0, status=0, data=None, vm=None):
+	if not scripting_vms:
+		return
+	if vm == None:
+		vm = scripting_vm_for(user_id, entity_id)
+	if vm.proc == None:
 		return
+	message = create_scripting_message(type, user_id, entity_id, other_id, status, data)
 	if SCRIPT_DEBUG_PRINTS:
-		print("SENDING", create_scripting_message(type, user_id, entity_id, other_id, status, data))
-	scripting_service_proc.stdin.write(create_scripting_message(type, user_id, entity_id, other_id, status, data))
+		print("SENDING %d" % vm.index, message)
+	vm.queue_message(type, entity_id, message)
+
+class ScriptingVM(object):
+	def __init__(self, index):
+		self.index = index
+		self.proc = None
+		self.restarts = 0
+		self.shutting_down = False
+
+		# Outgoing messages are queued per entity and written by write_messages(), which takes turns between
+		# entities and waits for the pipe to drain, so a slow VM or one busy script can't make the server's memory use grow forever
+		self.outbound_queues = {}     # entity_id -> deque of encoded messages
+		self.outbound_bytes = {}      # entity_id -> number of bytes in that entity's queue
+		self.outbound_ready = deque() # entity_ids that have queued messages, in the order they'll get a turn
+		self.outbound_event = asyncio.Event()
+
+		self.queued_bytes = 0
+		self.sent_bytes = 0
+		self.sent_messages = 0
+		self.dropped_callbacks = 0
+
+	def queue_message(self, type, entity_id, message):
+		size = len(message)
+		queue = self.outbound_queues.get(entity_id)
+		if queue == None:
+			queue = deque()
+			self.outbound_queues[entity_id] = queue
+			self.outbound_bytes[entity_id] = 0
+			self.outbound_ready.append(entity_id)
+		elif type == VM_MessageType.CALLBACK and self.outbound_bytes[entity_id] + size > Config["Scripting"]["EntityQueueLimit"]:
+			# Callbacks are the only thing that's safe to lose; anything else would leave the script waiting forever
+			self.dropped_callbacks += 1
+			return
+		queue.append(message)
+		self.outbound_bytes[entity_id] += size
+		self.queued_bytes += size
+		self.outbound_event.set()
+
+	def clear_queues(self):
+		self.outbound_queues.clear()
+		self.outbound_bytes.clear()
+		self.outbound_ready.clear()
+		self.queued_bytes = 0
+
+	async def write_messages(self, stdin):
+		while True:
+			await self.outbound_event.wait()
+			self.outbound_event.clear()
+
+			while self.outbound_ready:
+				# Take one message from each entity in turn until the batch is full
+				batch = []
+				batch_size = 0
+				while self.outbound_ready and batch_size < scripting_write_batch_size:
+					entity_id = self.outbound_ready.popleft()
+					queue = self.outbound_queues[entity_id]
+					message = queue.popleft()
+					batch.append(message)
+					batch_size += len(message)
+					if queue:
+						self.outbound_bytes[entity_id] -= len(message)
+						self.outbound_ready.append(entity_id)
+					else:
+						del self.outbound_queues[entity_id]
+						del self.outbound_bytes[entity_id]
+
+				self.queued_bytes -= batch_size
+				self.sent_bytes += batch_size
+				self.sent_messages += len(batch)
+				try:
+					stdin.write(b''.join(batch))
+					await stdin.drain()
+				except (BrokenPipeError, ConnectionResetError):
+					return
+
+	def stats_text(self):
+		return "%d bytes queued for %d entities, %d messages sent (%d bytes), %d callbacks dropped, %d restarts" % (self.queued_bytes, len(self.outbound_queues), self.sent_messages, self.sent_bytes, self.dropped_callbacks, self.restarts)
+
+	def restart_scripts(self):
+		""" Start the scripts that were running in this VM's previous process again """
+		for e in tuple(AllEntitiesByID.values()):
+			if e.entity_type == entity_type['gadget'] and e.script_running and e.script_vm is self:
+				e.restart_scripts()
+
+	async def run(self):
+		while True:
+			self.proc = await asyncio.create_subprocess_exec(Config["Scripting"]["ProgramPath"], stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+			print("Scripting service %d:" % self.index, self.proc)
+			if self.restarts:
+				self.restart_scripts()
+
+			writer_task = asyncio.create_task(self.write_messages(self.proc.stdin))
+			await read_scripting_messages(self)
+
+			# Wait for the subprocess exit.
+			writer_task.cancel()
+			await self.proc.wait()
+			self.proc = None
+			self.clear_queues()
+			if self.shutting_down or ServerShutdown[0] > 0:
+				break
+			self.restarts += 1
+			print("Scripting service %d stopped unexpectedly; restarting it" % self.index)
+			await asyncio.sleep(min(self.restarts, 30))
 
 # -----------------------------------------------------------------------------
 
@@ -739,31 +942,28 @@ def entity_id_int_to_string(e):
 	else:
 		return "~" + str(-e)
 
-scripting_service_proc = None
 async def run_scripting_service():
-	global scripting_service_proc, GlobalData
+	global GlobalData
 	GlobalData['request_script_status'] = request_script_status # Try to work around a circular dependency
 	GlobalData['shutdown_scripting_service'] = shutdown_scripting_service
 
 	print("Running scripting service")
-	scripting_service_proc = await asyncio.create_subprocess_exec(Config["Scripting"]["ProgramPath"], stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
-	print(scripting_service_proc)
+	scripting_vms.extend(ScriptingVM(i) for i in range(max(1, Config["Scripting"]["ProcessCount"])))
+	await asyncio.gather(*(vm.run() for vm in scripting_vms))
 
-	quit = False
-	while not quit:
+async def read_scripting_messages(vm):
+	stdout = vm.proc.stdout
+	while True:
 		e = None
 		owner = None
-		type_and_size = await scripting_service_proc.stdout.read(4)
-		if len(type_and_size) == 0:
+		try:
+			header = await stdout.readexactly(scripting_message_header_size)
+			type_and_size, user_id, entity_id, other_id, status = scripting_message_header.unpack(header)
+			message_type = type_and_size & 255
+			data_size = type_and_size >> 8
+			data = await stdout.readexactly(data_size) if data_size else b''
+		except asyncio.IncompleteReadError:
 			break
-		message_type = type_and_size[0]
-		data_size = int.from_bytes(type_and_size[1:], byteorder='little')
-		rest_of_message = await scripting_service_proc.stdout.read((4*3+1) + data_size)
-		user_id   = int.from_bytes(rest_of_message[0:4], byteorder='little', signed=True)
-		entity_id = int.from_bytes(rest_of_message[4:8], byteorder='little', signed=True)
-		other_id  = int.from_bytes(rest_of_message[8:12], byteorder='little', signed=True)
-		status    = rest_of_message[12]
-		data      = rest_of_message[13:]
 
 		try:
 			if message_type == VM_MessageType.API_CALL or message_type == VM_MessageType.API_CALL_GET:
@@ -778,9 +978,45 @@ async def run_scripting_service():
 					if message_type == VM_MessageType.API_CALL_GET and (out is not do_not_return_response):
 						if not isinstance(out, list):
 							out = [out]
-						send_scripting_message(VM_MessageType.API_CALL_GET, user_id=user_id, entity_id=entity_id, other_id=other_id, status=len(out), data=encode_scripting_message_values(out))
+						send_scripting_message(VM_MessageType.API_CALL_GET, user_id=user_id, entity_id=entity_id, other_id=other_id, status=len(out), data=encode_scripting_message_values(out), vm=vm)
 				else:
 					print("Unimplemented API call: "+values[0])
+			elif message_type == VM_MessageType.API_CALL_MULTI:
+				# Each call is an integer argument count, the function name, and then the arguments.
+				# If status is nonzero, the response has an integer result count followed by the results, for each call.
+				values = decode_scripting_message_values(data)
+				e = find_entity(entity_id)
+				if not e:
+					e = get_entity_by_id(entity_id, load_from_db=True, do_not_load_scripts=True)
+				if not e:
+					continue
+				results = []
+				call_count = 0
+				i = 0
+				while i+1 < len(values):
+					arg_count = values[i]
+					name = values[i+1]
+					args = values[i+2:i+2+arg_count]
+					i += 2 + arg_count
+					call_count += 1
+					out = []
+					if name in script_api_handlers:
+						try:
+							out = script_api_handlers[name](e, args)
+						except Exception:
+							print("Exception thrown from API call %s in a batch:" % name, sys.exc_info()[0])
+							print(sys.exc_info()[1])
+							out = []
+					else:
+						print("Unimplemented API call: "+name)
+					if out is do_not_return_response: # Calls that respond on their own have no result here
+						out = []
+					elif not isinstance(out, list):
+						out = [out]
+					results.append(len(out))
+					results.extend(out)
+				if status:
+					send_scripting_message(VM_MessageType.API_CALL_MULTI, user_id=user_id, entity_id=entity_id, other_id=other_id, status=call_count, data=encode_scripting_message_values(results), vm=vm)
 			elif message_type == VM_MessageType.SET_CALLBACK:
 				e = find_entity(entity_id)
 				if not e:
@@ -797,7 +1033,7 @@ async def run_scripting_service():
 						e.map.broadcast("WHO", {"update": {"id": e.protocol_id(), "clickable": bool(status)}})
 					e.script_callback_enabled[other_id] = bool(status)
 			elif message_type == VM_MessageType.PING:
-				send_scripting_message(VM_MessageType.PONG, user_id=user_id, entity_id=entity_id, other_id=other_id, status=status, data=None)
+				send_scripting_message(VM_MessageType.PONG, user_id=user_id, entity_id=entity_id, other_id=other_id, status=status, data=None, vm=vm)
 			elif message_type == VM_MessageType.SCRIPT_ERROR:
 				e = find_entity(entity_id)
 				if e:
@@ -808,10 +1044,7 @@ async def run_scripting_service():
 						else:
 							owner.send("ERR", {'text': 'Script error: %s' % (data.decode())})
 			elif message_type == VM_MessageType.STATUS_QUERY:
-				e = find_entity(other_id)
-				if not e:
-					continue
-				e.send("MSG", {'text': 'Scripting status: %s' % data.decode()})
+				receive_script_status(vm, other_id, data.decode())
 			elif message_type == VM_MessageType.SCRIPT_PRINT:
 				e = find_entity(entity_id)
 				if e:
@@ -823,19 +1056,53 @@ async def run_scripting_service():
 			print(sys.exc_info()[1])
 			traceback.print_tb(sys.exc_info()[2])
 		#print(message_type, user_id, entity_id, other_id, status, data)
-		#print(type_and_size + rest_of_message)
-
-	# Wait for the subprocess exit.
-	await scripting_service_proc.wait()
 
 def shutdown_scripting_service(user_id=0):
-	send_scripting_message(VM_MessageType.SHUTDOWN, user_id=user_id)
+	# A user's scripts can be spread across VMs if gadgets changed owners while running, so ask all of them
+	if user_id:
+		for vm in scripting_vms:
+			send_scripting_message(VM_MessageType.SHUTDOWN, user_id=user_id, vm=vm)
+		return
+	for vm in scripting_vms:
+		vm.shutting_down = True
+		send_scripting_message(VM_MessageType.SHUTDOWN, vm=vm)
+
+# Status replies from each VM get collected into one message; other_id -> [replies still expected, replies]
+script_status_requests = {}
 
 def request_script_status(client, arg):
 	if arg == "s":
-		send_scripting_message(VM_MessageType.STATUS_QUERY, status=1, other_id=client.db_id)
+		user_id, status, vms = 0, 1, scripting_vms
+	elif len(arg) == 0:
+		user_id, status, vms = 0, 0, scripting_vms
+	else:
+		user_id = int(arg)
+		status, vms = 0, scripting_vms
+	vms = [vm for vm in vms if vm.proc != None]
+	if not vms:
+		client.send("ERR", {'text': 'Scripting service isn\'t running'})
 		return
-	if len(arg) == 0:
-		send_scripting_message(VM_MessageType.STATUS_QUERY, other_id=client.db_id)
+	script_status_requests[client.db_id] = [len(vms), []]
+	for vm in vms:
+		send_scripting_message(VM_MessageType.STATUS_QUERY, user_id=user_id, status=status, other_id=client.db_id, vm=vm)
+	asyncio.get_event_loop().call_later(5, finish_script_status, client.db_id)
+
+def receive_script_status(vm, other_id, text):
+	request = script_status_requests.get(other_id)
+	if request == None:
+		return
+	if len(scripting_vms) > 1:
+		request[1].append((vm.index, '[VM %d] %s; server side: %s' % (vm.index, text, vm.stats_text())))
+	else:
+		request[1].append((vm.index, '%s; server side: %s' % (text, vm.stats_text())))
+	request[0] -= 1
+	if request[0] <= 0:
+		finish_script_status(other_id)
+
+def finish_script_status(other_id):
+	request = script_status_requests.pop(other_id, None)
+	if request == None or not request[1]:
 		return
-	send_scripting_message(VM_MessageType.STATUS_QUERY, user_id=int(arg), other_id=client.db_id)
+	e = find_entity(other_id)
+	if e:
+		e.send("MSG", {'text': 'Scripting status: %s' % ' | '.join(text for index, text in sorted(request[1]))})
@@ -0,0 +1,343 @@
+# Tilemap Town
+# Copyright (C) 2017-2026 NovaSquirrel
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json, struct, zlib
+from array import array
+from collections import Counter
+
+# Binary map data format
+MAP_BLOB_MAGIC = b'TMTM'
+MAP_BLOB_VERSION = 1
+MAP_CHUNK_SIZE = 16
+map_blob_header = struct.Struct('<4sHHHBBI') # magic, version, width, height, chunk size, flags, length of extra JSON
+map_blob_directory_entry = struct.Struct('<II') # offset from the start of the chunk data, length (0 if chunk is empty)
+map_blob_layer_header = struct.Struct('<HI') # palette size, length of palette JSON
+
+# Header flags
+MAP_BLOB_FLAG_CHUNK_TABLE = 1 # Chunks are in the Map_Chunk table instead of after the header, so there's no directory
+
+def tile_palette_key(value):
+	""" Hashable key used to find identical tiles; strings are used as-is, anything else goes through JSON """
+	if isinstance(value, str):
+		return value
+	return (json.dumps(value, sort_keys=True, separators=(',', ':')),)
+
+class TileGrid(object):
+	""" One layer of a map (turfs or objs), stored as palette indexes instead of a list of lists.
+	Index 0 is always None. Cells are stored column by column, so cell (x,y) is at x*height+y. """
+
+	def __init__(self, width, height):
+		self.width = width
+		self.height = height
+		self.clear_palette()
+		self.cells = array('H', bytes(2 * width * height))
+
+	def clear_palette(self):
+		self.palette = [None]     # palette[index] = tile value
+		self.palette_refs = [0]   # How many cells use each palette index
+		self.palette_lookup = {}  # tile_palette_key(value) -> index
+		self.palette_free = []    # Indexes that can be reused
+
+	def __repr__(self):
+		return "TileGrid(%d, %d, palette=%d)" % (self.width, self.height, len(self.palette) - len(self.palette_free))
+
+	# Palette management
+
+	def intern(self, value):
+		""" Get the palette index for a tile, adding it to the palette if it's not there yet """
+		if value == None:
+			return 0
+		key = tile_palette_key(value)
+		index = self.palette_lookup.get(key)
+		if index != None:
+			return index
+		if self.palette_free:
+			index = self.palette_free.pop()
+			self.palette[index] = value
+			self.palette_refs[index] = 0
+		else:
+			index = len(self.palette)
+			self.palette.append(value)
+			self.palette_refs.append(0)
+			if index > 0xffff and self.cells.typecode == 'H':
+				self.cells = array('I', self.cells)
+		self.palette_lookup[key] = index
+		return index
+
+	def release(self, index, count=1):
+		""" Stop counting some cells as using a palette index, and free the index if nothing uses it anymore """
+		if index == 0:
+			return
+		self.palette_refs[index] -= count
+		if self.palette_refs[index] <= 0:
+			del self.palette_lookup[tile_palette_key(self.palette[index])]
+			self.palette[index] = None
+			self.palette_refs[index] = 0
+			self.palette_free.append(index)
+
+	# Cell access
+
+	def get(self, x, y):
+		return self.palette[self.cells[x * self.height + y]]
+
+	def get_index(self, x, y):
+		return self.cells[x * self.height + y]
+
+	def in_bounds(self, x, y):
+		return x >= 0 and y >= 0 and x < self.width and y < self.height
+
+	def set(self, x, y, value):
+		# A flat array would let an out-of-range y spill into the next column, so check first
+		if not self.in_bounds(x, y):
+			raise IndexError("Tile position %d,%d is outside of the %dx%d grid" % (x, y, self.width, self.height))
+		self.set_index(x, y, self.intern(value))
+
+	def set_index(self, x, y, index):
+		i = x * self.height + y
+		old = self.cells[i]
+		if old == index:
+			return
+		if index:
+			self.palette_refs[index] += 1
+		self.cells[i] = index
+		self.release(old)
+
+	def fill(self, x1, y1, x2, y2, value):
+		""" Set every cell in a rectangle (inclusive) to the same value """
+		if x2 < x1 or y2 < y1:
+			return
+		if not self.in_bounds(x1, y1) or not self.in_bounds(x2, y2):
+			raise IndexError("Rectangle %d,%d-%d,%d is outside of the %dx%d grid" % (x1, y1, x2, y2, self.width, self.height))
+		index = self.intern(value)
+		for x in range(x1, x2+1):
+			for y in range(y1, y2+1):
+				self.set_index(x, y, index)
+
+	def items_in(self, x1, y1, x2, y2):
+		""" Yield [x, y, value] for every non-empty cell in a rectangle (inclusive), in the same order as map_section() """
+		palette = self.palette
+		cells = self.cells
+		height = self.height
+		for x in range(x1, x2+1):
+			base = x * height
+			for y in range(y1, y2+1):
+				index = cells[base + y]
+				if index:
+					yield [x, y, palette[index]]
+
+	def any_in(self, x1, y1, x2, y2):
+		""" True if any cell in the rectangle (inclusive) is not empty """
+		cells = self.cells
+		height = self.height
+		for x in range(x1, x2+1):
+			base = x * height
+			if any(cells[base + y1 : base + y2 + 1]):
+				return True
+		return False
+
+	def index_rows(self, x1, y1, x2, y2):
+		""" Return the palette indexes in a rectangle (inclusive) as a list of rows, top to bottom """
+		cells = self.cells
+		height = self.height
+		return list(zip(*(cells[x * height + y1 : x * height + y2 + 1] for x in range(x1, x2+1))))
+
+	# Whole-grid operations
+
+	def resize(self, width, height):
+		""" Change the grid's size, keeping the top left part of it. Cells that get cut off are released. """
+		if width == self.width and height == self.height:
+			return
+		new_cells = array(self.cells.typecode, bytes(self.cells.itemsize * width * height))
+		for x in range(self.width):
+			base = x * self.height
+			if x < width:
+				keep = min(height, self.height)
+				new_cells[x * height : x * height + keep] = self.cells[base : base + keep]
+				cut = self.cells[base + keep : base + self.height]
+			else:
+				cut = self.cells[base : base + self.height]
+			for index in cut:
+				self.release(index)
+		self.cells = new_cells
+		self.width = width
+		self.height = height
+
+	def copy(self):
+		""" Make an independent copy of the grid; tile values themselves are shared, since they're never modified in place """
+		other = TileGrid.__new__(TileGrid)
+		other.width = self.width
+		other.height = self.height
+		other.palette = list(self.palette)
+		other.palette_refs = list(self.palette_refs)
+		other.palette_lookup = dict(self.palette_lookup)
+		other.palette_free = list(self.palette_free)
+		other.cells = array(self.cells.typecode, self.cells)
+		return other
+
+	def used_palette_count(self):
+		return len(self.palette) - len(self.palette_free) - 1
+
+	# Chunk encoding
+
+	def encode_chunk(self, x1, y1, x2, y2):
+		""" Encode a rectangle (inclusive) as a local palette followed by local palette indexes, column by column.
+		An empty rectangle is just a header with a palette size of zero. """
+		cells = self.cells
+		height = self.height
+		columns = [cells[x * height + y1 : x * height + y2 + 1] for x in range(x1, x2+1)]
+		if not any(any(column) for column in columns):
+			return map_blob_layer_header.pack(0, 0)
+
+		local_for = {0: 0} # Grid palette index -> local palette index
+		local = array('H')
+		for column in columns:
+			for index in column:
+				local_index = local_for.get(index)
+				if local_index == None:
+					local_index = len(local_for)
+					local_for[index] = local_index
+				local.append(local_index)
+		del local_for[0]
+		palette_json = json.dumps([self.palette[index] for index in local_for], separators=(',', ':')).encode()
+		if len(local_for) < 256:
+			local = array('B', local)
+		return map_blob_layer_header.pack(len(local_for), len(palette_json)) + palette_json + local.tobytes()
+
+	def decode_chunk(self, x1, y1, x2, y2, data, offset=0):
+		""" Decode something encode_chunk() made into a rectangle of the grid that's currently empty.
+		Returns the offset right after the chunk's data. """
+		palette_size, palette_json_length = map_blob_layer_header.unpack_from(data, offset)
+		offset += map_blob_layer_header.size
+		if palette_size == 0:
+			return offset
+
+		local_palette = json.loads(bytes(data[offset : offset + palette_json_length]))
+		offset += palette_json_length
+		chunk_width = x2 - x1 + 1
+		chunk_height = y2 - y1 + 1
+		local = array('B' if palette_size < 256 else 'H')
+		local_length = chunk_width * chunk_height * local.itemsize
+		local.frombytes(data[offset : offset + local_length])
+		offset += local_length
+
+		remap = [0] + [self.intern(value) for value in local_palette]
+		for local_index, count in Counter(local).items():
+			if local_index:
+				self.palette_refs[remap[local_index]] += count
+
+		typecode = self.cells.typecode
+		for i, x in enumerate(range(x1, x2+1)):
+			base = x * self.height
+			self.cells[base + y1 : base + y2 + 1] = array(typecode, map(remap.__getitem__, local[i * chunk_height : (i+1) * chunk_height]))
+		return offset
+
+def map_chunk_index(x, y, height, chunk_size=MAP_CHUNK_SIZE):
+	""" Which chunk a tile is in, counting in the same order as map_chunk_rectangles() """
+	return (x // chunk_size) * ((height + chunk_size - 1) // chunk_size) + (y // chunk_size)
+
+def map_chunk_indexes_in(x1, y1, x2, y2, height, chunk_size=MAP_CHUNK_SIZE):
+	""" Every chunk index that a rectangle (inclusive) touches """
+	chunks_high = (height + chunk_size - 1) // chunk_size
+	return [cx * chunks_high + cy for cx in range(x1 // chunk_size, x2 // chunk_size + 1) for cy in range(y1 // chunk_size, y2 // chunk_size + 1)]
+
+def map_chunk_rectangles(width, height, chunk_size=MAP_CHUNK_SIZE):
+	""" List of (x1, y1, x2, y2) for each chunk on a map, in the order they're stored """
+	return [(x, y, min(x + chunk_size, width) - 1, min(y + chunk_size, height) - 1) for x in range(0, width, chunk_size) for y in range(0, height, chunk_size)]
+
+def encode_map_chunk(turfs, objs, rectangle):
+	""" Both layers of one chunk, compressed; empty bytes if there's nothing in the chunk """
+	x1, y1, x2, y2 = rectangle
+	if not turfs.any_in(x1, y1, x2, y2) and not objs.any_in(x1, y1, x2, y2):
+		return b''
+	return zlib.compress(turfs.encode_chunk(x1, y1, x2, y2) + objs.encode_chunk(x1, y1, x2, y2), level=5)
+
+def encode_map_blob(turfs, objs, extra, chunk_table=False):
+	""" Make the binary version of a map's data. "extra" is a dictionary of other map data to keep, like edge links.
+	Layout: header, extra JSON, chunk directory, then each chunk (see encode_map_chunk).
+	If chunk_table is true, it stops after the extra JSON, and the caller saves the chunks separately. """
+	width, height = turfs.width, turfs.height
+	extra_json = json.dumps(extra, separators=(',', ':')).encode()
+	if chunk_table:
+		return map_blob_header.pack(MAP_BLOB_MAGIC, MAP_BLOB_VERSION, width, height, MAP_CHUNK_SIZE, MAP_BLOB_FLAG_CHUNK_TABLE, len(extra_json)) + extra_json
+	directory = bytearray()
+	chunk_data = bytearray()
+	for rectangle in map_chunk_rectangles(width, height):
+		chunk = encode_map_chunk(turfs, objs, rectangle)
+		directory += map_blob_directory_entry.pack(len(chunk_data), len(chunk))
+		chunk_data += chunk
+	return map_blob_header.pack(MAP_BLOB_MAGIC, MAP_BLOB_VERSION, width, height, MAP_CHUNK_SIZE, 0, len(extra_json)) + extra_json + directory + chunk_data
+
+def is_map_blob(data):
+	return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[0:4]) == MAP_BLOB_MAGIC
+
+class MapBlob(object):
+	""" Binary map data read from the database. Only the header and chunk directory are parsed up front;
+	chunks are decompressed when they're actually needed. If uses_chunk_table is true, the chunks
+	aren't in the blob, and whoever loaded it needs to fill in chunk_rows (chunk index -> chunk). """
+
+	def __init__(self, data):
+		self.data = memoryview(data)
+		magic, version, self.width, self.height, self.chunk_size, self.flags, extra_length = map_blob_header.unpack_from(self.data, 0)
+		if magic != MAP_BLOB_MAGIC:
+			raise ValueError("Not binary map data")
+		if version > MAP_BLOB_VERSION:
+			raise ValueError("Binary map data is version %d, but only version %d is supported" % (version, MAP_BLOB_VERSION))
+		offset = map_blob_header.size
+		self.extra = json.loads(bytes(self.data[offset : offset + extra_length]))
+		offset += extra_length
+
+		self.chunks = map_chunk_rectangles(self.width, self.height, self.chunk_size)
+		self.uses_chunk_table = bool(self.flags & MAP_BLOB_FLAG_CHUNK_TABLE)
+		self.chunk_rows = {}
+		if not self.uses_chunk_table:
+			self.directory = [map_blob_directory_entry.unpack_from(self.data, offset + i * map_blob_directory_entry.size) for i in range(len(self.chunks))]
+			self.chunk_data_start = offset + len(self.chunks) * map_blob_directory_entry.size
+
+	def get_chunk_data(self, chunk_index):
+		""" Compressed data for one chunk, or empty bytes if the chunk is empty """
+		if self.uses_chunk_table:
+			return self.chunk_rows.get(chunk_index, b'')
+		chunk_offset, chunk_length = self.directory[chunk_index]
+		start = self.chunk_data_start + chunk_offset
+		return self.data[start : start + chunk_length]
+
+	def decode_chunk_into(self, chunk_index, turfs, objs):
+		chunk = self.get_chunk_data(chunk_index)
+		if not chunk:
+			return
+		chunk = zlib.decompress(chunk)
+		x1, y1, x2, y2 = self.chunks[chunk_index]
+		offset = turfs.decode_chunk(x1, y1, x2, y2, chunk)
+		objs.decode_chunk(x1, y1, x2, y2, chunk, offset)
+
+	def load_into(self, turfs, objs):
+		""" Decode every chunk into a pair of empty grids the same size as the map """
+		for i in range(len(self.chunks)):
+			self.decode_chunk_into(i, turfs, objs)
+
+	def section(self, x1, y1, x2, y2):
+		""" Get the turfs and objs in a rectangle (inclusive), as lists in the format map_section() uses,
+		only decoding the chunks that overlap the rectangle """
+		x1 = min(self.width-1, max(0, x1))
+		y1 = min(self.height-1, max(0, y1))
+		x2 = min(self.width-1, max(0, x2))
+		y2 = min(self.height-1, max(0, y2))
+		turfs = TileGrid(self.width, self.height)
+		objs = TileGrid(self.width, self.height)
+		for i, (cx1, cy1, cx2, cy2) in enumerate(self.chunks):
+			if cx2 >= x1 and cx1 <= x2 and cy2 >= y1 and cy1 <= y2:
+				self.decode_chunk_into(i, turfs, objs)
+		return (list(turfs.items_in(x1, y1, x2, y2)), list(objs.items_in(x1, y1, x2, y2)))
@@ -198,6 +198,14 @@ foreign key(group_id) references Entity(id) on delete cascade,
 foreign key(member_id) references Entity(id) on delete cascade
 )""")
 
+c.execute("""create table if not exists Map_Chunk (
+map_id integer,
+chunk_index integer,
+data blob,
+primary key(map_id, chunk_index),
+foreign key(map_id) references Entity(id) on delete cascade
+)""")
+
 c.execute("""create table if not exists Global_Entity_Key (
 entity_id integer,
 key text,
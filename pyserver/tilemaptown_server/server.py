@@ -22,68 +22,38 @@ from .buildprotocol import handle_protocol_command, protocol_command_already_rec
 from .buildapi import start_api
 from .buildscripting import run_scripting_service, shutdown_scripting_service
 if Config["Database"]["Setup"]:
-	from .database_setup_v3 import *
+	from .database_setup_v4 import *
 else:
 	reload_database_meta()
+check_database_indexes()
 
 # To share with API
 total_connections = [0, 0, 0]
 
 # Timer that runs and performs background tasks
+# (request expiry, rate limiting cleanup and ping timeouts are scheduled individually with call_later_weakly)
 async def main_timer():
 	global ServerShutdown
 	loop = asyncio.get_event_loop()
+	seconds_since_commit = 0
+	seconds_since_checkpoint = 0
+	checkpoint_future = None
 
 	while True:
-		# Let requests expire
-		removeFromAllEntitiesWithRequests = set()
-		for c in AllEntitiesWithRequests:
-			if not c.requests:
-				removeFromAllEntitiesWithRequests.add(c)
-				continue
-			# Remove requests that time out
-			remove_requests = set()
-			for k,v in c.requests.items():
-				v[0] -= 1 # remove 1 from timer
-				if v[0] < 0:
-					remove_requests.add(k)
-			for r in remove_requests:
-				del c.requests[r]
-		for c in removeFromAllEntitiesWithRequests:
-			AllEntitiesWithRequests.discard(c)
-
-		# Remove rate limiting information that's too old
-		current_minute = int(time.monotonic() // 60)
-		removeFromAllEntitiesWithRateLimiting = set()
-		for c in AllEntitiesWithRateLimiting:
-			# Stop tracking this entity because there's no longer any rate limiting info
-			if c.rate_limiting == {}:
-				removeFromAllEntitiesWithRateLimiting.add(c)
-				continue
-
-			# Remove rate limiting info that's too old
-			removed_type = set()
-			for type_name,type_data in c.rate_limiting.items():
-				while len(type_data) and current_minute >= (type_data[0][0] + 10): # Remove information from >= 10 minutes ago
-					type_data.popleft()
-				if len(type_data) == 0:
-					removed_type.add(type_name)
-			for r in removed_type:
-				del c.rate_limiting[r]
-		for c in removeFromAllEntitiesWithRateLimiting:
-			AllEntitiesWithRateLimiting.discard(c)
-		c = None
+		# Commit database writes that were batched up
+		seconds_since_commit += 1
+		if seconds_since_commit >= Config["Database"]["CommitInterval"]:
+			seconds_since_commit = 0
+			commit_database()
 
-		# Disconnect pinged-out users
-		for connection in AllConnections:
-			connection.idle_timer += 1
+		# Copy the write-ahead log into the database on the writer thread, since that's where the disk syncing happens
+		seconds_since_checkpoint += 1
+		if Config["Database"]["WAL"] and seconds_since_checkpoint >= Config["Database"]["CheckpointInterval"] and (checkpoint_future == None or checkpoint_future.done()):
+			seconds_since_checkpoint = 0
+			checkpoint_future = loop.run_in_executor(DatabaseWriter, checkpoint_database)
 
-			# Remove users that time out
-			connection.ping_timer -= 1
-			if connection.ping_timer == 60 or connection.ping_timer == 30:
-				connection.send("PIN", None)
-			elif connection.ping_timer < 0:
-				connection.disconnect(reason="PingTimeout")
+		# Save and unload maps that have been empty for a while
+		expire_warm_maps()
 
 		# Run server shutdown timer, if it's running
 		if ServerShutdown[0] > 0:
@@ -101,7 +71,17 @@ async def main_timer():
 
 		await asyncio.sleep(1)
 
+async def move_timer():
+	""" Send the MOV messages that maps have been holding onto since the last move tick """
+	while True:
+		# Read the rate every tick, since /rehash can change it; when it's zero, just flush anything queued from before
+		rate = Config["Server"]["MoveBroadcastRate"]
+		await asyncio.sleep(1 / rate if rate > 0 else 1)
+		for map in tuple(MapsWithPendingMoves):
+			map.send_pending_moves()
+
 def save_everything():
+	evict_all_warm_maps()
 	for e in AllEntitiesByDB.values():
 		if (e.save_on_clean_up and not e.temporary) or (e.is_client() and e.db_id):
 			e.save()
@@ -188,7 +168,7 @@ async def client_handler(websocket):
 				arg = json.loads(message[4:])
 
 			# Process the command
-			connection.idle_timer = 0
+			connection.last_message_at = time.monotonic()
 			echo = arg.get("echo")
 			ack_req = arg.get("ack_req")
 			if isinstance(ack_req, str):
@@ -309,12 +289,16 @@ async def async_main():
 	websocket_server = await websockets.serve(client_handler, None, Config["Server"]["Port"], max_size=Config["Server"]["WSMaxSize"], max_queue=Config["Server"]["WSMaxQueue"], origins=Config["Security"]["AllowedOrigins2"], ping_interval=Config["Server"]["WSPingInterval"], ping_timeout=Config["Server"]["WSPingTimeout"])
 	server_task = asyncio.create_task(websocket_server.serve_forever())
 	timer_task = asyncio.create_task(main_timer())
+	move_timer_task = asyncio.create_task(move_timer()) # Kept here, since the event loop only holds weak references to tasks
 	if Config["Scripting"]["Enabled"]:
 		scripting_service_task = asyncio.create_task(run_scripting_service())
 
 	if Config["API"]["Enabled"]:
 		await start_api(asyncio.get_event_loop(), Config["API"]["Port"], total_connections=total_connections)
-	await server_task
+	try:
+		await server_task
+	finally:
+		move_timer_task.cancel()
 
 def main():
 	try:
@@ -324,6 +308,8 @@ def main():
 		save_everything()
 	finally:
 		Database.commit()
+		close_database_writer()
+		close_database_reader()
 		print("Closing the database")
 		Database.close()
 
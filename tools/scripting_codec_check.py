@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+#
+# Round trip checks and a microbenchmark for the scripting VM message codec
+#
+# Copying and distribution of this file, with or without
+# modification, are permitted in any medium without royalty
+# provided the copyright notice and this notice are preserved.
+# This file is offered as-is, without any warranty.
+#
+# Run from anywhere; the server package is found relative to this file, and
+# the working directory is moved to a temporary folder so that importing the
+# server doesn't touch a real database.
+import os, sys, json, struct, tempfile, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pyserver'))
+os.chdir(tempfile.mkdtemp())
+
+import tilemaptown_server.buildglobal # Imports the rest of the server in the right order
+from tilemaptown_server.buildscripting import encode_scripting_message_values, decode_scripting_message_values, create_scripting_message, ScriptingValueType, VM_MessageType
+
+# .--------------------------------------------------------
+# | Reference implementation (the original byte concatenation codec)
+# '--------------------------------------------------------
+
+def old_encode(values):
+	b = bytes()
+	for x in values:
+		if x == None:
+			b += bytes([ScriptingValueType.NIL])
+		elif isinstance(x, bool) and x == True:
+			b += bytes([ScriptingValueType.TRUE])
+		elif isinstance(x, bool) and x == False:
+			b += bytes([ScriptingValueType.FALSE])
+		elif isinstance(x, int):
+			b += bytes([ScriptingValueType.INTEGER]) + x.to_bytes(4, byteorder='little', signed=x < 0)
+		elif isinstance(x, str):
+			d = x.encode()
+			b += bytes([ScriptingValueType.STRING]) + len(d).to_bytes(4, byteorder='little') + d
+		else:
+			d = json.dumps(x).encode()
+			b += bytes([ScriptingValueType.JSON]) + len(d).to_bytes(4, byteorder='little') + d
+	return b
+
+def old_decode(b):
+	values = []
+	i = 0
+	while i < len(b):
+		t = b[i]
+		i += 1
+		if t == ScriptingValueType.NIL:
+			values.append(None)
+		elif t == ScriptingValueType.FALSE:
+			values.append(False)
+		elif t == ScriptingValueType.TRUE:
+			values.append(True)
+		elif t == ScriptingValueType.INTEGER:
+			values.append(int.from_bytes(b[i:i+4], byteorder='little', signed=True))
+			i += 4
+		elif t == ScriptingValueType.STRING or t == ScriptingValueType.JSON:
+			size = int.from_bytes(b[i:i+4], byteorder='little')
+			i += 4
+			values.append(b[i:i+size].decode() if t == ScriptingValueType.STRING else json.loads(b[i:i+size]))
+			i += size
+		elif t == ScriptingValueType.MINI_TILEMAP:
+			values.append(old_decode_mini_tilemap(b[i:]))
+			i += 4 + len(values[-1][2]) * 4
+	return values
+
+def old_decode_mini_tilemap(b):
+	width, height = b[0], b[1]
+	length = int.from_bytes(b[2:4], byteorder='little', signed=False)
+	i = 4
+	map = []
+	for j in range(length):
+		map.append(int.from_bytes(b[i:i+4], byteorder='little', signed=False))
+		i += 4
+	return (width, height, map)
+
+def encode_mini_tilemap(width, height, words):
+	return bytes([ScriptingValueType.MINI_TILEMAP]) + struct.pack('<BBH%dI' % len(words), width, height, len(words), *words)
+
+# .--------------------------------------------------------
+# | Round trip checks
+# '--------------------------------------------------------
+
+failures = 0
+def check(name, got, expected):
+	global failures
+	if got != expected:
+		failures += 1
+		print("FAIL %s: got %r, expected %r" % (name, got, expected))
+
+samples = [
+	[],
+	[None],
+	[True, False, None],
+	[0, 1, -1, 2147483647, -2147483648, 4294967295],
+	["", "hello", "café \U0001F600", "a" * 100000],
+	[{"a": [1, 2, 3], "b": None}, [1, "two", 3.5], 1.25],
+	["map", 5, None, True, {"nested": {"x": "y"}}, -7, "end"],
+]
+
+for values in samples:
+	encoded = encode_scripting_message_values(values)
+	check("same bytes as the old encoder for %.40r" % (values,), bytes(encoded), old_encode(values))
+	decoded = decode_scripting_message_values(encoded)
+	# 4294967295 comes back signed, which is how the VM's integers work too
+	expected = [(x - 0x100000000 if isinstance(x, int) and not isinstance(x, bool) and x > 0x7fffffff else x) for x in values]
+	check("round trip of %.40r" % (values,), decoded, expected)
+	check("decode from bytes of %.40r" % (values,), decode_scripting_message_values(bytes(encoded)), expected)
+
+for width, height in ((1, 1), (4, 4), (8, 8), (16, 16)):
+	words = [(i * 2654435761) & 0xffffffff for i in range(width * height)]
+	b = encode_mini_tilemap(width, height, words)
+	check("mini tilemap %dx%d" % (width, height), decode_scripting_message_values(b), [(width, height, words)])
+	check("mini tilemap %dx%d matches old decoder" % (width, height), decode_scripting_message_values(b)[0], old_decode_mini_tilemap(b[1:]))
+check("mini tilemap followed by other values", decode_scripting_message_values(encode_mini_tilemap(2, 1, [7, 8]) + old_encode(["x", 3])), [(2, 1, [7, 8]), "x", 3])
+
+for data in (None, b"", b"abc", bytes(range(256)) * 10):
+	message = create_scripting_message(VM_MessageType.API_CALL_GET, user_id=-5, entity_id=123456, other_id=-2147483648, status=200, data=data)
+	expected = VM_MessageType.API_CALL_GET.to_bytes(1, byteorder='little') \
+		+ (len(data) if data else 0).to_bytes(3, byteorder='little') \
+		+ (-5).to_bytes(4, byteorder='little', signed=True) \
+		+ (123456).to_bytes(4, byteorder='little', signed=True) \
+		+ (-2147483648).to_bytes(4, byteorder='little', signed=True) \
+		+ (200).to_bytes(1, byteorder='little') \
+		+ (data or b"")
+	check("message header with %d bytes of data" % (len(data) if data else 0), bytes(message), expected)
+
+if failures:
+	print("%d checks failed" % failures)
+	sys.exit(1)
+print("All codec checks passed")
+
+# .--------------------------------------------------------
+# | Microbenchmark
+# '--------------------------------------------------------
+
+if "--no-benchmark" not in sys.argv:
+	call = ["m_tilemap", 12, 34, "some text argument", {"key": "value", "list": list(range(20))}, True, None] * 8
+	frame = encode_mini_tilemap(16, 16, list(range(256)))
+
+	def report(name, new, old, number):
+		new_time = timeit.timeit(new, number=number)
+		old_time = timeit.timeit(old, number=number)
+		print("%-28s new %8.2f us  old %8.2f us  (%.1fx)" % (name, new_time / number * 1000000, old_time / number * 1000000, old_time / new_time))
+
+	report("encode API call values", lambda: encode_scripting_message_values(call), lambda: old_encode(call), 5000)
+	encoded_call = bytes(encode_scripting_message_values(call))
+	report("decode API call values", lambda: decode_scripting_message_values(encoded_call), lambda: old_decode(encoded_call), 5000)
+	report("decode 16x16 mini tilemap", lambda: decode_scripting_message_values(frame), lambda: old_decode(frame), 5000)
@@ -0,0 +1,52 @@
+#
+# Reading and writing map data for the tileset update scripts, in either of the formats the server saves it in
+#
+# Copying and distribution of this file, with or without
+# modification, are permitted in any medium without royalty
+# provided the copyright notice and this notice are preserved.
+# This file is offered as-is, without any warranty.
+#
+import json, os, sys, time, zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pyserver'))
+from tilemaptown_server.buildtilegrid import TileGrid, MapBlob, encode_map_blob, is_map_blob
+
+map_blob_data_marker = 'tmtmap' # Entity.data value for binary maps; same as in buildmap.py
+
+def load_map_data(db, map_id, data, compressed_data):
+	""" Get a map's data as a dictionary in the older JSON format ("pos", "turf", "obj" and anything extra like "edge_links"),
+	from an Entity row's data and compressed_data. Returns None if there isn't any """
+	if data == map_blob_data_marker and is_map_blob(compressed_data):
+		blob = MapBlob(compressed_data)
+		if blob.uses_chunk_table:
+			blob.chunk_rows = dict(db.execute('SELECT chunk_index, data FROM Map_Chunk WHERE map_id=?', (map_id,)).fetchall())
+		turfs, objs = blob.section(0, 0, blob.width-1, blob.height-1)
+		map_data = dict(blob.extra)
+		map_data.update({'pos': [0, 0, blob.width-1, blob.height-1], 'turf': turfs, 'obj': objs})
+		return map_data
+
+	if compressed_data == None:
+		text = data
+	elif data == 'zlib':
+		text = zlib.decompress(compressed_data).decode()
+	else:
+		print("Skipping map %s; its data is in a format this script doesn't know about (%r)" % (map_id, data))
+		return None
+	return json.loads(text) if text else None
+
+def save_map_data(db, map_id, map_data):
+	""" Save a dictionary from load_map_data() in the binary format. It's saved as one blob, and the server
+	moves the chunks into Map_Chunk the next time it saves the map """
+	width, height = map_data['pos'][2]+1, map_data['pos'][3]+1
+	turfs = TileGrid(width, height)
+	objs = TileGrid(width, height)
+	for x, y, turf in map_data['turf']:
+		turfs.set(x, y, turf)
+	for x, y, obj in map_data['obj']:
+		objs.set(x, y, obj)
+
+	extra = {key: value for key, value in map_data.items() if key not in ('pos', 'default', 'turf', 'obj')}
+	# Clients that cache maps need to see that the map changed
+	extra['content_version'] = max(extra.get('content_version', 0) + 1, int(time.time() * 1000))
+	db.execute("UPDATE Entity SET data=?, compressed_data=? WHERE id=?", (map_blob_data_marker, encode_map_blob(turfs, objs, extra), map_id))
+	db.execute('DELETE FROM Map_Chunk WHERE map_id=?', (map_id,))
@@ -1,27 +1,20 @@
 import json, sqlite3, zlib
 from PIL import Image
+from map_data import load_map_data
 
 def int_if_possible(n):
 	if n.isnumeric():
 		return int(n)
 	return n
 
-def decompress_entity_data(data, compressed_data):
-	if compressed_data == None:
-		return data
-	elif data == 'zlib':
-		return zlib.decompress(compressed_data).decode()
-	return None
-
 def scan_database(path):
 	Database = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
 	c = Database.cursor()
 	c2 = Database.cursor()
 	for row in c.execute('SELECT id, data, compressed_data FROM Entity WHERE type=2'):
-		data = decompress_entity_data(row[1], row[2])
+		data = load_map_data(Database, row[0], row[1], row[2])
 		if not data:
 			continue
-		data = json.loads(data)
 		turfs = data.get("turf")
 		objs = data.get("obj")
 
@@ -9,6 +9,7 @@
 # This file is offered as-is, without any warranty.
 #
 import json, sqlite3, zlib
+from map_data import load_map_data, save_map_data
 
 dry_run = False
 
@@ -32,13 +33,6 @@ def search_map_for_replacement(input_pic):
 			return [tileset, find_x, find_y]		
 	return invisible_wall_pic
 
-def decompress_entity_data(data, compressed_data):
-	if compressed_data == None:
-		return data
-	elif data == 'zlib':
-		return zlib.decompress(compressed_data).decode()
-	return None
-
 def fix_tile(tile_data):
 	fixed_anything = False
 	replacement_pic = search_map_for_replacement(tile_data.get('pic'))
@@ -69,10 +63,9 @@ def convert_database(path):
 	c = Database.cursor()
 	c2 = Database.cursor()
 	for row in c.execute('SELECT id, data, compressed_data FROM Entity WHERE type=2'):
-		data = decompress_entity_data(row[1], row[2])
+		data = load_map_data(Database, row[0], row[1], row[2])
 		if not data:
 			continue
-		data = json.loads(data)
 		turfs = data.get("turf")
 		objs = data.get("obj")
 		fixed_anything = False
@@ -88,11 +81,9 @@ def convert_database(path):
 					fixed_anything = fixed_anything or fixed_this
 		if fixed_anything:
 			print("Fixed map", row[0])
-			text = json.dumps(data)
 
 			if not dry_run:
-				c2.execute("UPDATE Entity SET data='zlib', compressed_data=? WHERE id=?", (zlib.compress(text.encode(), level = 5), row[0],))
-				print(c2.rowcount)
+				save_map_data(c2, row[0], data)
 
 	if not dry_run:
 		Database.commit()
@@ -9,6 +9,7 @@
 # This file is offered as-is, without any warranty.
 #
 import json, sqlite3, zlib
+from map_data import load_map_data, save_map_data
 
 dry_run = False
 
@@ -154,10 +155,9 @@ def convert_database(path):
 			print(json.dumps(data))
 
 	for row in c.execute('SELECT id, data, compressed_data FROM Entity WHERE type=2'):
-		data = decompress_entity_data(row[1], row[2])
+		data = load_map_data(Database, row[0], row[1], row[2])
 		if not data:
 			continue
-		data = json.loads(data)
 		turfs = data.get("turf")
 		objs = data.get("obj")
 		fixed_anything = False
@@ -204,11 +204,9 @@ def convert_database(path):
 
 		if fixed_anything:
 			print("Fixed map", row[0])
-			text = json.dumps(data)
 
 			if not dry_run:
-				c2.execute("UPDATE Entity SET data='zlib', compressed_data=? WHERE id=?", (zlib.compress(text.encode(), level = 5), row[0],))
-				print(c2.rowcount)
+				save_map_data(c2, row[0], data)
 
 	# Fix map default turf
 	for row in c.execute('SELECT entity_id, default_turf FROM Map'):